@@ -1,234 +1,1706 @@
+import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import getpass
+import hashlib
+import io
 import json
+import marshal
+import math
+import mmap
 import os
+import pickle
 import random as rng
-import requests
-from PIL import Image
+import sys
+import re
+import shlex
+import shutil
+import socket
+import socketserver
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+# Advisory file locks come from fcntl on Unix and msvcrt on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+# Line editing is used for tab completion, where the platform provides it
+try:
+    import readline
+except ImportError:
+    readline = None
+# requests and PIL are slow to import, so they are only imported by the code paths that use them. This keeps startup to the first prompt under 200 ms
+
+# Name index of the Oracle, loaded on first lookup (see method:loadIndex())
+nameIndex = None
+# Card name search structures, built on first search (see method:loadNameSearch())
+nameSearch = None
+# Read-only memory map of the Oracle and the stamp of the file it was opened on (see method:openOracleMap())
+oracleMap = None
+oracleMapStamp = None
+# Which backend to read Oracle records through: 'auto' to use the SQLite card store whenever it is up to date, or 'index' to always use the name index
+cardBackend = 'auto'
+# Read-only connection to the SQLite card store (see method:openCardStore())
+cardStore = None
+# Cards in the cache journal and the stamp of the journal they were read from (see method:loadCache())
+cacheCards = None
+cacheStamp = None
+# HTTP session shared by requests to Scryfall (see method:getHTTPSession())
+httpSession = None
+# Maximum total size in bytes of the card images kept in folder 'data/images/'
+imageCacheBudget = 256 * 1024 * 1024
+# Height of a card image over its width, used to size thumbnails
+CARD_ASPECT = 1040 / 745
+# Image cache hits and misses in this session (see method:readCachedImage())
+imageCacheStats = {'hits' : 0, 'misses' : 0}
+# Random card sampling pools by source, built on first draw (see method:loadSamplePool())
+samplePools = {}
+# Card attribute columns, loaded on first use (see method:loadCardColumns())
+cardColumns = None
+# Inverted indexes over Oracle text and type lines, loaded on first search (see method:loadSearchIndex())
+searchIndex = None
+# Fields of a Scryfall card record kept in slim card records, which are all the tool reads (see method:projectCard())
+CARD_FIELDS = ('name', 'mana_cost', 'cmc', 'type_line', 'oracle_text', 'colors', 'color_identity', 'power', 'toughness', 'legalities', 'layout', 'set', 'collector_number', 'image_uris', 'card_faces')
+CARD_FIELD_SET = frozenset(CARD_FIELDS)
+# Fields kept for each face of a card with several faces
+CARD_FACE_FIELDS = ('name', 'mana_cost', 'type_line', 'oracle_text', 'colors', 'power', 'toughness', 'image_uris')
+# Words of a type line given a flag bit each in the card attribute columns, in bit order
+CARD_TYPES = ['Land', 'Creature', 'Instant', 'Sorcery', 'Artifact', 'Enchantment', 'Planeswalker', 'Battle', 'Legendary', 'Basic', 'Tribal', 'Kindred']
+# Functions served by the card service daemon (see method:runDaemon())
+SERVICE_OPS = ['lookupCard', 'lookupRandom', 'resolveCards', 'loadDeck', 'resolveDeck', 'addToDeck', 'removeFromDeck', 'addManyToDeck', 'commitDeckChanges', 'createDeck', 'deleteDeck', 'findCards', 'sampleCards', 'searchCards', 'completeCardName', 'suggestCardNames', 'deckStats', 'poolStats', 'cardUsage', 'diffDecks', 'similarDecks', 'cloneDeck']
+# Functions of var:SERVICE_OPS that only read prebuilt indexes, and can run alongside other requests
+SERVICE_READ_OPS = ['searchCards', 'completeCardName', 'suggestCardNames']
+# Lock serializing every other request to the card service
+serviceLock = threading.RLock()
+# Lock serializing loads and rebuilds of the in-memory indexes, which read requests to the card service can set off side by side
+indexLock = threading.RLock()
+# Connection to the card service, when running as its client (see method:connectDaemon())
+daemonConnection = None
+# Decklist formats supported by method:exportDeck(), mapped to their usual file extension
+EXPORT_FORMATS = {'default' : '.txt', 'plain' : '.txt', 'mtgo' : '.txt', 'arena' : '.txt', 'csv' : '.csv'}
+# Connection to the cross-deck index, the process that opened it, and whether it may be behind the deck files (see method:openDeckIndex())
+deckIndex = None
+deckIndexPid = None
+deckIndexStale = False
+# Names of the file locks held by each thread (see method:lockFile())
+heldLocks = threading.local()
+# Metrics collected by the instrumentation layer, or None while it is disabled (see method:enableInstrumentation())
+metrics = None
+# Lock guarding var:metrics against the threads of the image prefetcher and card service
+metricsLock = threading.Lock()
+# Functions whose latency is recorded while instrumentation is enabled
+INSTRUMENTED_FUNCTIONS = ['loadIndex', 'loadNameSearch', 'readOracleRecord', 'readCard', 'findCards', 'lookupCard', 'lookupRandom', 'resolveCards', 'loadCache', 'cacheData', 'compactCache', 'readCachedImage', 'writeCachedImage', 'fetchCardImage', 'prefetchDeckImages', 'printCard', 'renderContactSheet', 'loadDeck', 'saveDeck', 'commitDeckChanges', 'addToDeck', 'removeFromDeck', 'addManyToDeck', 'createDeck', 'deleteDeck', 'printDeck', 'exportDeck', 'goldfish', 'simulateGoldfish', 'sampleCards', 'searchCards', 'suggestCardNames', 'deckStats', 'poolStats', 'pullData', 'buildIndex', 'buildCardStore']
+# Upper bounds in seconds of the latency histogram buckets, followed by one bucket for anything slower
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+# Folder to write a cProfile capture of each command to, or None to not profile (see method:startCommand())
+profileFolder = None
+profileCount = 0
+# Name, start time and profiler of the command being timed (see method:startCommand())
+runningCommand = None
+
+"""
+param: cardName, name of card in any case, with or without commas.
+return: key used to compare card names (non-case-sensitive, ignores commas).
+"""
+def normalizeName(cardName:str) -> str:
+    return cardName.lower().replace(",","")
+# END NORMALIZENAME
+
+"""
+pre: file 'data/oracle.json' must exist.
+return: read-only memory map of 'data/oracle.json', or None if the file is empty.
+post: map is opened once per process and reopened if the Oracle has changed since.
+"""
+def openOracleMap() -> mmap.mmap:
+    global oracleMap, oracleMapStamp
+    stamp = getOracleStamp()
+    # Reuse the open map as long as the Oracle has not changed underneath it
+    if oracleMap != None and oracleMapStamp == stamp:
+        return oracleMap
+    closeOracleMap()
+    # An empty file cannot be mapped
+    if stamp[0] == 0:
+        return None
+    with open('data/oracle.json', 'rb') as f:
+        # Map stays valid after the file object is closed
+        oracleMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    oracleMapStamp = stamp
+    return oracleMap
+# END OPENORACLEMAP
+
+"""
+post: memory map of the Oracle is released, so that 'data/oracle.json' can be replaced.
+"""
+def closeOracleMap():
+    global oracleMap, oracleMapStamp
+    if oracleMap != None:
+        oracleMap.close()
+    oracleMap = None
+    oracleMapStamp = None
+# END CLOSEORACLEMAP
+
+"""
+pre: file 'data/oracle.json' must exist.
+return: generator of (offset, length) byte spans, one for each top-level card object in the Oracle file, in file order.
+"""
+def iterOracleSpans():
+    data = openOracleMap()
+    if data == None:
+        return
+    depth = 0
+    start = 0
+    # Step over whole strings at once so braces inside card text are never counted
+    for match in re.finditer(rb'"(?:[^"\\]|\\.)*"|[{}]', data):
+        token = match.group()
+        if token == b'{':
+            # Opening brace at the top of the array starts a new card object
+            if depth == 0:
+                start = match.start()
+            depth += 1
+        elif token == b'}':
+            depth -= 1
+            # Closing brace back at the top of the array ends the current card object
+            if depth == 0:
+                yield start, match.end()-start
+# END ITERORACLESPANS
+
+"""
+pre: file 'data/oracle.json' must exist.
+return: generator of JSON card objects in the Oracle, in file order. Only one card is parsed and held at a time.
+"""
+def streamOracle():
+    for location in iterOracleSpans():
+        yield readOracleRecord(location)
+# END STREAMORACLE
+
+"""
+pre: file 'data/oracle.json' must exist.
+return: stamp identifying the current contents of 'data/oracle.json', used to detect a stale index.
+"""
+def getOracleStamp() -> list:
+    stat = os.stat('data/oracle.json')
+    return [stat.st_size, stat.st_mtime_ns]
+# END GETORACLESTAMP
+
+"""
+pre: file 'data/oracle.json' must exist.
+post: file 'data/index.json' maps the normalized name of every card in the Oracle to the byte offset and length of its record, and lists every card name as written in the Oracle. A snapshot of the index is written to 'data/index.marshal' as well (see method:saveIndexSnapshot()).
+return: the new index.
+"""
+def buildIndex() -> dict:
+    global nameIndex
+    cards = {}
+    names = []
+    for offset, length in iterOracleSpans():
+        card = readOracleRecord((offset, length))
+        key = normalizeName(card['name'])
+        # Keep the first record for a name, matching the order a scan of the Oracle would find it in
+        if key not in cards:
+            cards[key] = [offset, length]
+            names.append(card['name'])
+    nameIndex = {'oracle' : getOracleStamp(), 'cards' : cards, 'names' : names}
+    # Swap the new index in whole, so a process loading it never reads a partial file
+    writeFileAtomic('data/index.json', json.dumps(nameIndex))
+    saveIndexSnapshot()
+    return cards
+# END BUILDINDEX
+
+"""
+post: the index in memory is written to file 'data/index.marshal', which loads in about half the time of 'data/index.json'. The snapshot carries the stamp of the Oracle it was built from, so it is ignored once the Oracle changes.
+"""
+def saveIndexSnapshot():
+    cards = nameIndex['cards']
+    # Pack offsets and lengths into flat arrays, which unmarshal as single byte strings rather than one list per card
+    offsets = array.array('q', [span[0] for span in cards.values()])
+    lengths = array.array('q', [span[1] for span in cards.values()])
+    snapshot = {'oracle' : nameIndex['oracle'], 'keys' : list(cards), 'offsets' : offsets.tobytes(), 'lengths' : lengths.tobytes(), 'names' : nameIndex['names']}
+    # Write beside the old snapshot and swap it in, so a reader never sees a partial snapshot
+    with open('data/index.marshal.tmp', 'wb') as f:
+        marshal.dump(snapshot, f)
+    os.replace('data/index.marshal.tmp', 'data/index.marshal')
+# END SAVEINDEXSNAPSHOT
+
+"""
+param: stamp, stamp of the Oracle as returned by method:getOracleStamp().
+return: index read from snapshot 'data/index.marshal', in the form written by method:buildIndex(), or None if the snapshot is missing, unreadable or out of date with the Oracle.
+"""
+def loadIndexSnapshot(stamp:list) -> dict:
+    try:
+        # Read the file in one call, as unmarshalling straight from the file reads it in many small pieces
+        with open('data/index.marshal', 'rb') as f:
+            snapshot = marshal.loads(f.read())
+        if snapshot['oracle'] != stamp:
+            return None
+        offsets = array.array('q')
+        offsets.frombytes(snapshot['offsets'])
+        lengths = array.array('q')
+        lengths.frombytes(snapshot['lengths'])
+    # Snapshots written by another version of Python cannot be read back
+    except (FileNotFoundError, ValueError, EOFError, TypeError, KeyError):
+        return None
+    return {'oracle' : stamp, 'cards' : dict(zip(snapshot['keys'], zip(offsets, lengths))), 'names' : snapshot['names']}
+# END LOADINDEXSNAPSHOT
+
+"""
+pre: file 'data/oracle.json' must exist.
+return: dictionary mapping normalized card names to the location of their record in 'data/oracle.json'.
+post: index is loaded once per process from the snapshot 'data/index.marshal', falling back on 'data/index.json', and rebuilt if both are missing or out of date with the Oracle.
+"""
+def loadIndex() -> dict:
+    global nameIndex
+    stamp = getOracleStamp()
+    # Reuse the index already in memory as long as the Oracle has not changed underneath it
+    if nameIndex != None and nameIndex['oracle'] == stamp:
+        return nameIndex['cards']
+    with indexLock:
+        # Another thread may have loaded it while this one waited
+        if nameIndex != None and nameIndex['oracle'] == stamp:
+            return nameIndex['cards']
+        # Prefer the snapshot, which is the fastest to load
+        index = loadIndexSnapshot(stamp)
+        if index != None:
+            nameIndex = index
+            return nameIndex['cards']
+        try:
+            with open('data/index.json', encoding='utf8') as f:
+                index = json.load(f)
+            # Indexes written before card names were listed are rebuilt as well
+            if index['oracle'] == stamp and 'names' in index:
+                nameIndex = index
+                saveIndexSnapshot()
+                return nameIndex['cards']
+        # Fall through to a rebuild if the index is missing or unreadable
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        return buildIndex()
+# END LOADINDEX
+
+"""
+pre: file 'data/oracle.json' must exist.
+return: every card name in the Oracle, as written in the Oracle.
+"""
+def loadNames() -> list:
+    # Loading the index brings its list of names up to date
+    loadIndex()
+    return nameIndex['names']
+# END LOADNAMES
+
+"""
+pre: file 'data/oracle.json' must exist.
+return: search structures over every card name in the Oracle: normalized names in sorted order for prefix matches, and a map from each trigram of a normalized name to the names containing it for fuzzy matches.
+post: structures are built once per process, and again only if the Oracle has changed.
+"""
+def loadNameSearch() -> dict:
+    global nameSearch
+    stamp = getOracleStamp()
+    if nameSearch != None and nameSearch['oracle'] == stamp:
+        return nameSearch
+    with indexLock:
+        # Another thread may have built it while this one waited
+        if nameSearch != None and nameSearch['oracle'] == stamp:
+            return nameSearch
+        # Sorting normalized names lets a prefix be found by binary search
+        entries = sorted([(normalizeName(name), name) for name in loadNames()])
+        keys = [key for key, _ in entries]
+        names = [name for _, name in entries]
+        trigrams = {}
+        for i in range(len(keys)):
+            # Pad the name so its first and last letters also start and end trigrams
+            padded = '  ' + keys[i] + ' '
+            for j in range(len(padded)-2):
+                trigrams.setdefault(padded[j:j+3], []).append(i)
+        nameSearch = {'oracle' : stamp, 'keys' : keys, 'names' : names, 'trigrams' : trigrams}
+        return nameSearch
+# END LOADNAMESEARCH
 
 """
-pre: files 'data/cache.json' and 'data/oracle.json' must exist.
+pre: file 'data/oracle.json' must exist.
+param: prefix, start of a card name in any case, with or without commas.
+param: limit, maximum number of names to return.
+return: card names starting with param:prefix, in alphabetical order.
+"""
+def completeCardName(prefix:str, limit:int=20) -> list:
+    search = loadNameSearch()
+    key = normalizeName(prefix)
+    # Names sharing the prefix sit next to each other from the first name not less than it
+    i = bisect.bisect_left(search['keys'], key)
+    matches = []
+    while i < len(search['keys']) and search['keys'][i].startswith(key) and len(matches) < limit:
+        matches.append(search['names'][i])
+        i += 1
+    return matches
+# END COMPLETECARDNAME
+
+"""
+param: a, first string.
+param: b, second string.
+return: number of single-character insertions, deletions and substitutions needed to turn param:a into param:b.
+"""
+def editDistance(a:str, b:str) -> int:
+    previous = list(range(len(b)+1))
+    for i in range(1, len(a)+1):
+        current = [i]
+        for j in range(1, len(b)+1):
+            current.append(min(previous[j]+1, current[j-1]+1, previous[j-1] + (a[i-1] != b[j-1])))
+        previous = current
+    return previous[len(b)]
+# END EDITDISTANCE
+
+"""
+pre: file 'data/oracle.json' must exist.
+param: cardName, misspelled card name in any case, with or without commas.
+param: limit, maximum number of names to return.
+return: card names closest to param:cardName, closest first.
+"""
+def suggestCardNames(cardName:str, limit:int=5) -> list:
+    search = loadNameSearch()
+    key = normalizeName(cardName)
+    padded = '  ' + key + ' '
+    postings = [search['trigrams'].get(padded[j:j+3], []) for j in range(len(padded)-2)]
+    # Trigrams found in a large share of all names say little about a match and cost the most to count, so leave them out where rarer ones exist
+    rare = [posting for posting in postings if len(posting) <= len(search['keys']) // 20]
+    if len(rare) > 0:
+        postings = rare
+    # Count trigrams each name shares with the target to find a short list of candidates
+    shared = collections.Counter()
+    for posting in postings:
+        shared.update(posting)
+    candidates = [i for i, _ in shared.most_common(50)]
+    # Rank candidates by edit distance, breaking ties by the number of shared trigrams
+    candidates.sort(key=lambda i: (editDistance(key, search['keys'][i]), -shared[i]))
+    return [search['names'][i] for i in candidates[0:limit]]
+# END SUGGESTCARDNAMES
+
+"""
+param: cardName, name of card that was not found.
+post: closest card names in the Oracle are printed, if any.
+"""
+def printSuggestions(cardName:str):
+    suggestions = suggestCardNames(cardName)
+    if len(suggestions) > 0:
+        print('Did you mean: ' + ', '.join(suggestions) + '?')
+# END PRINTSUGGESTIONS
+
+"""
+return: line entered by the user, with tab completing card names where line editing is available.
+"""
+def inputCardName() -> str:
+    if readline == None:
+        return input()
+    # Complete the whole line as a card name, since names contain spaces
+    readline.set_completer(lambda text, state: (completeCardName(text) + [None])[state])
+    readline.set_completer_delims('')
+    try:
+        return input()
+    # Leave other prompts without card name completion
+    finally:
+        readline.set_completer(None)
+# END INPUTCARDNAME
+
+"""
+pre: file 'data/oracle.json' must exist.
+param: location, [offset, length] of a card record as stored in the index.
+return: JSON card object stored at param:location of the Oracle.
+"""
+def readOracleRecord(location:list) -> dict:
+    offset, length = location
+    if metrics != None:
+        countBytes('data/oracle.json', 'read', length)
+    # Parse only the slice of the mapped Oracle holding this record
+    return json.loads(openOracleMap()[offset:offset+length])
+# END READORACLERECORD
+
+"""
+param: record, JSON card object, either a full Scryfall record or one already projected.
+return: slim copy of param:record holding only the fields in var:CARD_FIELDS, with only the PNG among its images and only the formats it is legal in among its legalities.
+"""
+def projectCard(record:dict) -> dict:
+    slim = dict([(field, record[field]) for field in CARD_FIELDS if field in record])
+    if 'image_uris' in slim:
+        slim['image_uris'] = {'png' : slim['image_uris'].get('png')}
+    if 'legalities' in slim:
+        slim['legalities'] = dict([(fmt, legality) for fmt, legality in slim['legalities'].items() if legality == 'legal'])
+    if 'card_faces' in slim:
+        faces = []
+        for face in slim['card_faces']:
+            slimFace = dict([(field, face[field]) for field in CARD_FACE_FIELDS if field in face])
+            if 'image_uris' in slimFace:
+                slimFace['image_uris'] = {'png' : slimFace['image_uris'].get('png')}
+            faces.append(slimFace)
+        slim['card_faces'] = faces
+    return slim
+# END PROJECTCARD
+
+"""
+Slim card record, holding the fields of var:CARD_FIELDS in slots rather than a dictionary, which takes a fraction of the memory of a full Scryfall record. Fields are read like those of a JSON card object (card['name'], card.get('cmc', 0)), with missing fields absent as in Scryfall's data. Reading any other field loads the full record from the Oracle on first use.
+"""
+class Card:
+    __slots__ = CARD_FIELDS + ('record',)
+    """
+    param: slim, JSON card object as returned by method:projectCard().
+    """
+    def __init__(self, slim:dict):
+        for field in CARD_FIELDS:
+            setattr(self, field, slim.get(field))
+        self.record = None
+    def __getitem__(self, field:str):
+        if field in CARD_FIELD_SET:
+            value = getattr(self, field)
+            if value == None:
+                raise KeyError(field)
+            return value
+        return self.full()[field]
+    def get(self, field:str, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+    def __contains__(self, field:str) -> bool:
+        return self.get(field) != None
+    def __repr__(self) -> str:
+        return 'Card(' + repr(self.name) + ')'
+    """
+    return: the slim record as a JSON card object, as stored on disk.
+    """
+    def toDict(self) -> dict:
+        return dict([(field, getattr(self, field)) for field in CARD_FIELDS if getattr(self, field) != None])
+    """
+    return: full Scryfall record of the card, read from the Oracle on first use, or the slim record if the card is no longer in the Oracle.
+    """
+    def full(self) -> dict:
+        if self.record == None:
+            self.record = readFullCard(normalizeName(self.name))
+            if self.record == None:
+                self.record = self.toDict()
+        return self.record
+# END CARD
+
+"""
+param: obj, object the json module cannot serialize by itself.
+return: param:obj as a JSON card object if it is a slim card record, for use as the default of method:json.dumps().
+"""
+def encodeCard(obj) -> dict:
+    if isinstance(obj, Card):
+        return obj.toDict()
+    raise TypeError('Object of type ' + type(obj).__name__ + ' is not JSON serializable')
+# END ENCODECARD
+
+"""
+param: card, JSON card object.
+return: colors of param:card in WUBRG order as a single string, taken from its faces if the card itself has none listed.
+"""
+def getColorString(card:dict) -> str:
+    colors = set(card.get('colors', []))
+    for face in card.get('card_faces', []):
+        colors.update(face.get('colors', []))
+    return ''.join([color for color in 'WUBRG' if color in colors])
+# END GETCOLORSTRING
+
+"""
+pre: file 'data/oracle.json' must exist.
+post: file 'data/cards.db' is a SQLite database holding every card in the Oracle, with its normalized name, oracle_id, cmc, colors, type_line and set indexed, its slim record (see method:projectCard()) kept as text and its full record kept as a blob.
+"""
+def buildCardStore():
+    global cardStore
+    # Build beside the live store so readers never see a partial database
+    if os.path.isfile('data/cards.db.tmp'):
+        os.remove('data/cards.db.tmp')
+    conn = sqlite3.connect('data/cards.db.tmp')
+    # Journaling is pointless for a file that is thrown away if the build fails
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('CREATE TABLE meta (oracleSize INTEGER, oracleTime INTEGER)')
+    conn.execute('CREATE TABLE cards (id INTEGER PRIMARY KEY, key TEXT, oracle_id TEXT, name TEXT, cmc REAL, colors TEXT, type_line TEXT, set_code TEXT, slim TEXT, data BLOB)')
+    # Keep the first record for a name, matching the name index
+    conn.execute('CREATE UNIQUE INDEX cards_key ON cards (key)')
+    data = openOracleMap()
+    # Generate one row per card, keeping the raw bytes of each record as its blob
+    def rows():
+        for offset, length in iterOracleSpans():
+            record = data[offset:offset+length]
+            card = json.loads(record)
+            yield (normalizeName(card['name']), card.get('oracle_id'), card['name'], card.get('cmc', 0), getColorString(card), card.get('type_line', ''), card.get('set'), json.dumps(projectCard(card)), record)
+    # Insert every card in a single transaction
+    with conn:
+        conn.execute('INSERT INTO meta VALUES (?, ?)', getOracleStamp())
+        conn.executemany('INSERT OR IGNORE INTO cards (key, oracle_id, name, cmc, colors, type_line, set_code, slim, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows())
+    # Build the remaining indexes once all rows are in, which is faster than maintaining them row by row
+    with conn:
+        for column in ['oracle_id', 'cmc', 'colors', 'type_line', 'set_code']:
+            conn.execute('CREATE INDEX cards_' + column + ' ON cards (' + column + ')')
+    conn.close()
+    # Close any connection to the old store before swapping in the new one
+    if cardStore != None:
+        cardStore.close()
+        cardStore = None
+    os.replace('data/cards.db.tmp', 'data/cards.db')
+# END BUILDCARDSTORE
+
+"""
+pre: file 'data/oracle.json' must exist.
+return: connection to the SQLite card store 'data/cards.db', or None if var:cardBackend is 'index', or the store has not been built, was built from a different Oracle or was built before it kept slim records.
+"""
+def openCardStore() -> sqlite3.Connection:
+    global cardStore
+    if cardBackend == 'index':
+        return None
+    # A stale connection may still be reading a store that another process has since rebuilt, so reconnect once before giving up
+    for attempt in range(2):
+        if cardStore == None:
+            if not os.path.isfile('data/cards.db'):
+                return None
+            # Connection is shared by every thread of the process, and only ever read from
+            cardStore = sqlite3.connect('file:data/cards.db?mode=ro', uri=True, check_same_thread=False)
+            # Stores built before slim records were kept are passed over until rebuilt
+            if 'slim' not in [column[1] for column in cardStore.execute('PRAGMA table_info(cards)')]:
+                cardStore.close()
+                cardStore = None
+                return None
+        # Do not serve cards from a store left behind by an earlier Oracle
+        if list(cardStore.execute('SELECT oracleSize, oracleTime FROM meta').fetchone()) == getOracleStamp():
+            return cardStore
+        cardStore.close()
+        cardStore = None
+    return None
+# END OPENCARDSTORE
+
+"""
+pre: file 'data/oracle.json' must exist.
+param: key, normalized card name, as returned by method:normalizeName().
+return: slim record of the card with normalized name param:key in the Oracle, read through the SQLite card store if available and the name index otherwise, or None if not in Oracle.
+"""
+def readCard(key:str) -> Card:
+    store = openCardStore()
+    if store != None:
+        row = store.execute('SELECT slim FROM cards WHERE key = ?', (key,)).fetchone()
+        if row == None:
+            return None
+        return Card(json.loads(row[0]))
+    location = loadIndex().get(key)
+    if location == None:
+        return None
+    return Card(projectCard(readOracleRecord(location)))
+# END READCARD
+
+"""
+pre: file 'data/oracle.json' must exist.
+param: key, normalized card name, as returned by method:normalizeName().
+return: full JSON card object with normalized name param:key from the Oracle, read through the SQLite card store if available and the name index otherwise, or None if not in Oracle.
+"""
+def readFullCard(key:str) -> dict:
+    store = openCardStore()
+    if store != None:
+        row = store.execute('SELECT data FROM cards WHERE key = ?', (key,)).fetchone()
+        if row == None:
+            return None
+        return json.loads(row[0])
+    location = loadIndex().get(key)
+    if location == None:
+        return None
+    return readOracleRecord(location)
+# END READFULLCARD
+
+"""
+pre: file 'data/oracle.json' must exist, and the SQLite card store must have been built with method:buildCardStore().
+param: minCmc, lowest converted mana cost to include, or None for no lower bound.
+param: maxCmc, highest converted mana cost to include, or None for no upper bound.
+param: colors, exact colors to match in WUBRG order (e.g. 'UR', or '' for colorless), or None for any colors.
+param: typeLine, text the type line must contain (e.g. 'Creature'), or None for any type.
+param: setCode, set code to match (e.g. 'm10'), or None for any set.
+param: limit, maximum number of cards to return, or None for no limit.
+return: list of slim records of the cards in the Oracle matching every given filter, ordered by name, or None if the card store is not available.
+"""
+def findCards(minCmc:float=None, maxCmc:float=None, colors:str=None, typeLine:str=None, setCode:str=None, limit:int=None) -> list:
+    store = openCardStore()
+    if store == None:
+        return None
+    # Build the query out of the filters that were given
+    clauses = []
+    params = []
+    if minCmc != None:
+        clauses.append('cmc >= ?')
+        params.append(minCmc)
+    if maxCmc != None:
+        clauses.append('cmc <= ?')
+        params.append(maxCmc)
+    if colors != None:
+        clauses.append('colors = ?')
+        params.append(colors.upper())
+    if typeLine != None:
+        clauses.append('type_line LIKE ?')
+        params.append('%' + typeLine + '%')
+    if setCode != None:
+        clauses.append('set_code = ?')
+        params.append(setCode.lower())
+    query = 'SELECT slim FROM cards'
+    if len(clauses) > 0:
+        query += ' WHERE ' + ' AND '.join(clauses)
+    query += ' ORDER BY name'
+    if limit != None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    return [Card(json.loads(row[0])) for row in store.execute(query, params)]
+# END FINDCARDS
+
+"""
+pre: file 'data/oracle.json' must exist.
 param: cardName, name of card matching format of 'name' field of Oracle data.
-return: JSON card object with name param:cardName from cache, from Oracle if not in cache, or None if not in Oracle.
+return: slim record (see class:Card) of the card with name param:cardName from cache, from Oracle if not in cache, or None if not in Oracle.
 post: card is cached if not in cache already.
 """
-def lookupCard(cardName:str) -> dict:
+def lookupCard(cardName:str) -> Card:
+    # Normalize target name once rather than for every comparison
+    key = normalizeName(cardName)
     # Check in cache first to potentially save time
-    with open('data/cache.json', encoding='utf8') as f:
-        db = json.load(f)
-        for card in db:
-            # Compare target card to each card in cache (non-case-sensitive, ignores commas)
-            if card['name'].lower().replace(",","") == cardName.lower().replace(",",""):
-                return card
-    # If not in cache, have to pull from full Oracle database
-    with open('data/oracle.json', encoding='utf8') as f:
-        db = json.load(f)
-        for card in db:
-            # Compare target card to each card in Oracle (non-case-sensitive, ignores commas)
-            if card['name'].lower().replace(",","") == cardName.lower().replace(",",""):
-                # Cache card for ease of future use
-                cacheData(card)
-                return card
-        # Return error if card is not found in Oracle (DNE)
+    card = loadCache().get(key)
+    if metrics != None:
+        countEvent('cache_hit' if card != None else 'cache_miss')
+    if card != None:
+        return card
+    # If not in cache, find the card's record in the Oracle through the card store or name index
+    card = readCard(key)
+    # Return error if card is not found in Oracle (DNE)
+    if card == None:
         return None
+    # Cache card for ease of future use
+    cacheData(card)
+    return card
 # END LOOKUPCARD
 
 """
-pre: file 'data/cache.json' must exist.
-return: random JSON card object from cache.
+param: pool, 'cache' to draw from cached cards, or 'oracle' to draw from every card in the Oracle.
+return: slim record of a random card from param:pool, or None if it is empty.
 """    
-def lookupRandom() -> dict:
-    # Only draw from cache for random card pool, as full Oracle pool would be costly and full of unwanted cards
-    with open('data/cache.json', encoding='utf8') as f:
-        db = json.load(f)
-        numCards = len(db)
-        randIndex = rng.randint(0,numCards-1)
-        # Return card at random index in cache
-        return db[randIndex]
+def lookupRandom(pool:str='cache') -> Card:
+    if pool == 'oracle':
+        store = openCardStore()
+        if store != None:
+            # Pick a random row id and take the first card at or after it, skipping any gaps left by duplicate names
+            maxId = store.execute('SELECT MAX(id) FROM cards').fetchone()[0]
+            if maxId == None:
+                return None
+            row = store.execute('SELECT slim FROM cards WHERE id >= ? ORDER BY id LIMIT 1', (rng.randint(1,maxId),)).fetchone()
+            return Card(json.loads(row[0]))
+        db = list(loadIndex().values())
+        if len(db) == 0:
+            return None
+        return Card(projectCard(readOracleRecord(db[rng.randint(0,len(db)-1)])))
+    # Draw from cache by default, as full Oracle pool would be full of unwanted cards
+    db = list(loadCache().values())
+    numCards = len(db)
+    if numCards == 0:
+        return None
+    randIndex = rng.randint(0,numCards-1)
+    # Return card at random index in cache
+    return db[randIndex]
 # END LOOKUPRANDOM
-    
+
+"""
+param: colors, colors in any order and case (e.g. 'ug').
+return: bitmask of param:colors, with one bit for each of W, U, B, R and G.
+"""
+def getColorMask(colors) -> int:
+    mask = 0
+    for i in range(5):
+        if 'WUBRG'[i] in colors or 'wubrg'[i] in colors:
+            mask |= 1 << i
+    return mask
+# END GETCOLORMASK
+
+"""
+param: pool, 'cache' for cached cards, or 'oracle' for every card in the Oracle.
+return: sampling pool over param:pool: the normalized name of every card, along with index arrays of card positions by color identity bitmask, by type line word, by format in which the card is legal, and in order of cmc.
+post: pool is built once per process, and again only if its source has changed.
+"""
+def loadSamplePool(pool:str) -> dict:
+    if pool == 'oracle':
+        stamp = getOracleStamp()
+    else:
+        loadCache()
+        stamp = getCacheStamp()
+    if pool in samplePools and samplePools[pool]['stamp'] == stamp:
+        return samplePools[pool]
+    if pool == 'oracle':
+        cards = streamOracle()
+    else:
+        cards = list(loadCache().values())
+    keys = []
+    colors = {}
+    types = {}
+    legal = {}
+    cmcs = []
+    seen = set()
+    for card in cards:
+        key = normalizeName(card['name'])
+        # Keep one entry per name, matching the name index
+        if key in seen:
+            continue
+        seen.add(key)
+        i = len(keys)
+        keys.append(key)
+        colors.setdefault(getColorMask(card.get('color_identity', [])), []).append(i)
+        # Index each word of the type line, so supertypes, types and subtypes can all be filtered on
+        for word in set(card.get('type_line', '').lower().replace('—', ' ').replace('/', ' ').split()):
+            types.setdefault(word, []).append(i)
+        for fmt, legality in card.get('legalities', {}).items():
+            if legality == 'legal':
+                legal.setdefault(fmt, []).append(i)
+        cmcs.append((card.get('cmc', 0), i))
+    cmcs.sort()
+    samplePools[pool] = {'stamp' : stamp, 'keys' : keys, 'colors' : colors, 'types' : types, 'legal' : legal, 'cmcValues' : [cmc for cmc, _ in cmcs], 'cmcOrder' : [i for _, i in cmcs]}
+    return samplePools[pool]
+# END LOADSAMPLEPOOL
+
+"""
+param: n, number of cards to draw.
+param: replace, whether the same card can be drawn more than once. Without replacement, at most every matching card is drawn.
+param: pool, 'cache' to draw from cached cards, or 'oracle' to draw from every card in the Oracle.
+param: colors, colors that the color identity of every card drawn must fall within (e.g. 'rg' also allows mono-red, mono-green and colorless cards), or None for any.
+param: typeLine, word the type line of every card drawn must contain (e.g. 'creature' or 'elf'), or None for any.
+param: minCmc, lowest converted mana cost to draw, or None for no lower bound.
+param: maxCmc, highest converted mana cost to draw, or None for no upper bound.
+param: legalIn, format every card drawn must be legal in (e.g. 'modern'), or None for any.
+return: list of slim records of random cards from param:pool matching every given filter.
+"""
+def sampleCards(n:int, replace:bool=True, pool:str='cache', colors:str=None, typeLine:str=None, minCmc:float=None, maxCmc:float=None, legalIn:str=None) -> list:
+    samplePool = loadSamplePool(pool)
+    # Gather the card positions allowed by each given filter from the precomputed index arrays
+    allowed = []
+    if colors != None:
+        mask = getColorMask(colors)
+        # Allow every color identity that is a subset of the requested colors
+        allowed.append(set([i for identity, positions in samplePool['colors'].items() if identity & ~mask == 0 for i in positions]))
+    if typeLine != None:
+        allowed.append(set(samplePool['types'].get(typeLine.lower(), [])))
+    if legalIn != None:
+        allowed.append(set(samplePool['legal'].get(legalIn.lower(), [])))
+    if minCmc != None or maxCmc != None:
+        # Cards in a cmc range sit next to each other in cmc order
+        start = 0
+        end = len(samplePool['cmcValues'])
+        if minCmc != None:
+            start = bisect.bisect_left(samplePool['cmcValues'], minCmc)
+        if maxCmc != None:
+            end = bisect.bisect_right(samplePool['cmcValues'], maxCmc)
+        allowed.append(set(samplePool['cmcOrder'][start:end]))
+    if len(allowed) == 0:
+        candidates = range(len(samplePool['keys']))
+    else:
+        # Intersect starting from the smallest set
+        allowed.sort(key=len)
+        candidates = list(allowed[0].intersection(*allowed[1:]))
+    if len(candidates) == 0:
+        return []
+    if replace:
+        picks = rng.choices(candidates, k=n)
+    else:
+        picks = rng.sample(candidates, min(n, len(candidates)))
+    # Only the cards drawn are read, from the cache or Oracle depending on the pool
+    if pool == 'oracle':
+        return [readCard(samplePool['keys'][i]) for i in picks]
+    cache = loadCache()
+    return [cache[samplePool['keys'][i]] for i in picks]
+# END SAMPLECARDS
+
+"""
+param: text, space-separated filters for method:sampleCards(): 'c:' colors, 't:' type, 'cmc:' exact cmc or range such as '2-4', 'f:' format, and 'pool:oracle' to draw from the whole Oracle.
+return: dictionary of keyword arguments for method:sampleCards(), or None if any filter is not recognized.
+"""
+def parseSampleFilters(text:str) -> dict:
+    filters = {}
+    for term in text.split():
+        prefix, _, value = term.partition(':')
+        prefix = prefix.lower()
+        if value == '':
+            return None
+        if prefix == 'c':
+            filters['colors'] = value
+        elif prefix == 't':
+            filters['typeLine'] = value
+        elif prefix == 'f':
+            filters['legalIn'] = value
+        elif prefix == 'pool' and value.lower() in ('cache', 'oracle'):
+            filters['pool'] = value.lower()
+        elif prefix == 'cmc':
+            low, _, high = value.partition('-')
+            try:
+                filters['minCmc'] = float(low)
+                filters['maxCmc'] = float(high) if high != '' else float(low)
+            except ValueError:
+                return None
+        else:
+            return None
+    return filters
+# END PARSESAMPLEFILTERS
+
 """
-pre: file 'data/cache.json' must exist and have some data in it. If creating a new cache, this data can just be '[]'.
-param: card, JSON card object to be cached.
-post: card is written to cache.
+return: stamp identifying the current contents of 'data/cache.jsonl', or None if it does not exist.
+"""
+def getCacheStamp() -> list:
+    try:
+        stat = os.stat('data/cache.jsonl')
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+# END GETCACHESTAMP
+
+"""
+return: dictionary mapping normalized card names to the slim records of the cards in the cache.
+post: cache journal 'data/cache.jsonl' is read once per process and again only if another process has written to it. A cache in the old 'data/cache.json' format is migrated, and the journal is compacted if it has collected duplicate or torn entries.
+"""
+def loadCache() -> dict:
+    stamp = getCacheStamp()
+    # Reuse the cache already in memory as long as the journal has not changed underneath it
+    if cacheCards != None and cacheStamp == stamp:
+        return cacheCards
+    # Read without the cache lock, so processes loading the cache at the same time do not queue behind each other
+    if readCache():
+        return cacheCards
+    # What looks like a torn entry may be one another process is still appending, so read again holding the cache lock before repairing the journal
+    with lockFile('cache'):
+        if not readCache():
+            compactCache()
+            # Any cache in the old format has now been carried over to the journal
+            if os.path.isfile('data/cache.json'):
+                os.remove('data/cache.json')
+    return cacheCards
+# END LOADCACHE
+
+"""
+post: cards in the cache journal 'data/cache.jsonl' are read into the cache in memory, or from the old 'data/cache.json' format if there is no journal yet.
+return: False if the journal needs rewriting by method:compactCache(): when it holds a torn entry, full rather than slim records, twice as many entries as cards, or has yet to be migrated from the old format.
+"""
+def readCache() -> bool:
+    global cacheCards, cacheStamp
+    stamp = getCacheStamp()
+    if stamp == None:
+        cacheCards = {}
+        cacheStamp = None
+        # Carry over a cache written in the old single-array format
+        if os.path.isfile('data/cache.json'):
+            with open('data/cache.json', encoding='utf8') as f:
+                for card in json.load(f):
+                    cacheCards.setdefault(normalizeName(card['name']), Card(projectCard(card)))
+            return False
+        return True
+    cacheCards = {}
+    entries = 0
+    torn = False
+    full = False
+    with open('data/cache.jsonl', 'rb') as f:
+        for line in f:
+            entries += 1
+            # A write cut short by a crash leaves a final line that is unterminated or does not parse
+            if not line.endswith(b'\n'):
+                torn = True
+            try:
+                card = json.loads(line)
+            except ValueError:
+                torn = True
+                continue
+            # Journals written before cards were projected hold full records
+            if not CARD_FIELD_SET.issuperset(card):
+                card = projectCard(card)
+                full = True
+            cacheCards.setdefault(normalizeName(card['name']), Card(card))
+    cacheStamp = stamp
+    # Rewrite the journal once it holds a torn entry or full records, or twice as many entries as cards
+    return not (torn or full or (entries > 100 and entries > 2 * len(cacheCards)))
+# END READCACHE
+
+"""
+pre: the cache lock must be held (see method:lockFile()).
+post: cache journal 'data/cache.jsonl' is atomically replaced with one entry for each card currently in the cache.
+"""
+def compactCache():
+    global cacheStamp
+    # Write the compacted journal beside the live one, then swap it in so a crash never leaves a partial cache
+    with open('data/cache.jsonl.tmp', 'w', encoding='utf8') as f:
+        for card in cacheCards.values():
+            f.write(json.dumps(card.toDict()) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace('data/cache.jsonl.tmp', 'data/cache.jsonl')
+    cacheStamp = getCacheStamp()
+# END COMPACTCACHE
+
+"""
+param: card, JSON card object or slim card record to be cached.
+post: the slim record of the card is appended to the cache journal 'data/cache.jsonl'.
 """           
 def cacheData(card:dict):
-    # Initialize new cache in case cache fails to open due to DNE
-    cache = '[]'
-    with open('data/cache.json', 'r') as f:
-        # Read cache
-        cache = f.read()
-    with open('data/cache.json', 'w') as f:
-        # Write back all but closing ']'
-        f.write(cache[0:len(cache)-1])
-    with open('data/cache.json', 'a') as f:
-        # Add line break unless cache var is empty (would consist only of '[]')
-        if len(cache) > 2:
-            f.write(',\n')
-        # Write in new card    
-        json.dump(card, f)
-        # Close cache
-        f.write(']')
+    global cacheStamp
+    with lockFile('cache'):
+        # Bring in-memory cache up to date, which also repairs a torn journal before appending to it
+        cache = loadCache()
+        key = normalizeName(card['name'])
+        if key in cache:
+            return
+        if not isinstance(card, Card):
+            card = Card(projectCard(card))
+        with open('data/cache.jsonl', 'a', encoding='utf8') as f:
+            # Write in new card as a single line
+            f.write(json.dumps(card.toDict()) + '\n')
+        cache[key] = card
+        cacheStamp = getCacheStamp()
 # END CACHEDATA
         
 """
-pre: files 'data/cache.json' and 'data/oracle.json' must exist.
-param: cardName, name of card matching format of 'name' field of Oracle data.
-return: Relevant data from the card with name param:cardName is displayed.
+param: card, JSON card object.
+return: url of the PNG image of param:card, using its front face for cards whose faces have separate images, or None if it has no image.
 """
-def printCard(cardName:str):
-    # Check in cache first to potentially save time
-    with open('data/cache.json', encoding='utf8') as f:
-        db = json.load(f)
-        for card in db:
-            # Compare target card to each card in cache (non-case-sensitive, ignores commas)
-            if card['name'].lower().replace(",","") == cardName.lower().replace(",",""):
-                # Extract url for PNG image from card object
-                imgSrc = card['image_uris']['png']
-                # Request image from url and proceed if succesful
-                response = requests.get(imgSrc)
-                if response.ok:
-                    # Write image content to a temp file
-                    with open('data/temp.png', 'wb') as f:
-                        f.write(response.content)
-                    # Load and display temp file
-                    img = Image.open('data/temp.png')
-                    img.show()
-                # Search is concluded
-                return
-    # If not in cache, have to pull from full Oracle database
-    with open('data/oracle.json', encoding='utf8') as f:
-        db = json.load(f)
-        for card in db:
-            # Compare target card to each card in Oracle (non-case-sensitive, ignores commas)
-            if card['name'].lower().replace(",","") == cardName.lower().replace(",",""):
-                # Extract url for PNG image from card object
-                imgSrc = card['image_uris']['png']
-                # Request image from url and proceed if succesful
-                response = requests.get(imgSrc)
-                if response.ok:
-                    # Write image content to a temp file
-                    with open('data/temp.png', 'wb') as f:
-                        f.write(response.content)
-                    # Load and display temp file
-                    img = Image.open('data/temp.png')
-                    img.show()
-                # Search is concluded
-                return
-# END PRINTCARD
+def getImageURI(card:dict) -> str:
+    if 'image_uris' in card:
+        return card['image_uris'].get('png')
+    # Double-faced cards only carry images on their faces
+    faces = card.get('card_faces', [])
+    if len(faces) > 0 and 'image_uris' in faces[0]:
+        return faces[0]['image_uris'].get('png')
+    return None
+# END GETIMAGEURI
+
+"""
+param: imgSrc, url of a card image.
+return: path of the file in folder 'data/images/' caching the image at param:imgSrc, named after a hash of the url.
+"""
+def getImagePath(imgSrc:str) -> str:
+    return 'data/images/' + hashlib.sha1(imgSrc.encode('utf8')).hexdigest() + '.png'
+# END GETIMAGEPATH
+
+"""
+param: imgSrc, url of a card image.
+return: content of the image at param:imgSrc, or None if it is not in the image cache.
+post: a cached image is marked as most recently used.
+"""
+def readCachedImage(imgSrc:str) -> bytes:
+    imgPath = getImagePath(imgSrc)
+    try:
+        with open(imgPath, 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        imageCacheStats['misses'] += 1
+        return None
+    # Refresh modification time, which orders images for eviction
+    os.utime(imgPath)
+    imageCacheStats['hits'] += 1
+    return content
+# END READCACHEDIMAGE
+
+"""
+param: imgSrc, url of a card image.
+param: content, content of the image at param:imgSrc.
+param: evict, whether to evict images after writing. Callers writing many images at once can evict once at the end instead.
+post: image is written to the image cache, and least recently used images are evicted until the cache fits var:imageCacheBudget.
+"""
+def writeCachedImage(imgSrc:str, content:bytes, evict:bool=True):
+    os.makedirs('data/images', exist_ok=True)
+    # Write to a file unique to this writer, then swap it in so concurrent viewers never see a partial image
+    fd, tempPath = tempfile.mkstemp(dir='data/images', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    os.replace(tempPath, getImagePath(imgSrc))
+    # Files opened from descriptors bypass the counting open(), so count the write here
+    if metrics != None:
+        countBytes(getImagePath(imgSrc), 'write', len(content))
+    if evict:
+        evictCachedImages()
+# END WRITECACHEDIMAGE
+
+"""
+post: least recently used images are removed from folder 'data/images/' until the images left fit var:imageCacheBudget, along with their thumbnails in folder 'data/thumbs/'.
+"""
+def evictCachedImages():
+    # Nothing to evict if no image has ever been written
+    if not os.path.isdir('data/images'):
+        return
+    entries = []
+    total = 0
+    for entry in os.scandir('data/images'):
+        if entry.name.endswith('.png'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+            total += stat.st_size
+    # Remove oldest images first
+    entries.sort()
+    thumbFolders = [entry.path for entry in os.scandir('data/thumbs') if entry.is_dir()] if os.path.isdir('data/thumbs') else []
+    for _, size, path in entries:
+        if total <= imageCacheBudget:
+            break
+        for removePath in [path] + [folder + '/' + os.path.basename(path) for folder in thumbFolders]:
+            try:
+                os.remove(removePath)
+            # Another process may have evicted the same image already, and most images have no thumbnails
+            except FileNotFoundError:
+                pass
+        total -= size
+# END EVICTCACHEDIMAGES
+
+"""
+param: card, JSON card object.
+return: content of the PNG image of param:card from the image cache, from Scryfall if not in the image cache, or None if it has no image or the download failed.
+post: a downloaded image is written to the image cache.
+"""
+def fetchCardImage(card:dict) -> bytes:
+    imgSrc = getImageURI(card)
+    if imgSrc == None:
+        return None
+    # Check in image cache first to avoid a network round trip
+    content = readCachedImage(imgSrc)
+    if content != None:
+        return content
+    # Request image from url and cache it if succesful
+    response = getHTTPSession().get(imgSrc)
+    if not response.ok:
+        return None
+    writeCachedImage(imgSrc, response.content)
+    return response.content
+# END FETCHCARDIMAGE
+
+"""
+return: HTTP session shared by every request to Scryfall in this process, so connections are reused between requests.
+"""
+def getHTTPSession() -> 'requests.Session':
+    global httpSession
+    if httpSession == None:
+        httpSession = makeHTTPSession(1)
+    return httpSession
+# END GETHTTPSESSION
+
+"""
+param: poolSize, number of connections to keep open to each host, which should match the number of threads sharing the session.
+return: new HTTP session.
+"""
+def makeHTTPSession(poolSize:int) -> 'requests.Session':
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if metrics != None:
+        session.hooks['response'].append(recordHTTPResponse)
+    return session
+# END MAKEHTTPSESSION
+
+"""
+param: limiter, rate limiter state as created by method:prefetchDeckImages().
+post: blocks until the calling thread may send its next request without going over the rate of param:limiter.
+"""
+def waitForRateLimit(limiter:dict):
+    # Reserve the next free slot while holding the lock, then sleep until it comes round outside of it
+    with limiter['lock']:
+        now = time.monotonic()
+        slot = max(now, limiter['next'])
+        limiter['next'] = slot + limiter['interval']
+    if slot > now:
+        time.sleep(slot - now)
+# END WAITFORRATELIMIT
+
+"""
+param: imgSrc, url of a card image.
+param: session, HTTP session to request the image through.
+param: limiter, rate limiter state as created by method:prefetchDeckImages().
+param: retries, number of times to retry a request that failed with a connection error, a 429 or a 5xx response.
+return: True if the image at param:imgSrc was downloaded and written to the image cache.
+"""
+def prefetchImage(imgSrc:str, session:'requests.Session', limiter:dict, retries:int) -> bool:
+    import requests
+    for attempt in range(retries+1):
+        # Back off exponentially before each retry
+        if attempt > 0:
+            time.sleep(limiter['backoff'] * 2**(attempt-1))
+        waitForRateLimit(limiter)
+        try:
+            response = session.get(imgSrc, timeout=30)
+        except requests.RequestException:
+            continue
+        if response.ok:
+            writeCachedImage(imgSrc, response.content, evict=False)
+            return True
+        # Any other client error will not go away on retry
+        if response.status_code != 429 and response.status_code < 500:
+            return False
+    return False
+# END PREFETCHIMAGE
+
+"""
+pre: file corresponding to param:deckName must exist.
+param: deckName, name of deck whose card images are to be fetched.
+param: workers, number of images to download at once.
+param: rate, maximum number of requests to send per second, across all workers.
+param: retries, number of times to retry each failed image.
+param: session, HTTP session to download through. A session pooling param:workers connections is created if None.
+post: every card image of the deck missing from the image cache is downloaded into it, and least recently used images are then evicted as usual.
+return: -1 if file corresponding to param:deckName does not exist, otherwise 0, along with the number of images downloaded and the list of card names whose image could not be downloaded.
+"""
+def prefetchDeckImages(deckName:str, workers:int=8, rate:float=10.0, retries:int=3, session:'requests.Session'=None) -> (int, int, list):
+    # Read deck and return error code if requested deck DNE
+    deck = loadDeck(deckName)
+    if deck == None:
+        return -1, 0, []
+    found, failures = resolveCards(list(deck))
+    # Collect each image missing from the cache once, however many cards share it
+    missing = {}
+    for card in found.values():
+        imgSrc = getImageURI(card)
+        if imgSrc == None:
+            failures.append(card['name'])
+        elif imgSrc not in missing and not os.path.isfile(getImagePath(imgSrc)):
+            missing[imgSrc] = card['name']
+    if len(missing) == 0:
+        return 0, 0, failures
+    if session == None:
+        session = makeHTTPSession(workers)
+    limiter = {'lock' : threading.Lock(), 'next' : 0.0, 'interval' : 1.0 / rate, 'backoff' : 0.5}
+    fetched = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lambda imgSrc: prefetchImage(imgSrc, session, limiter, retries), list(missing))
+        for imgSrc, ok in zip(list(missing), results):
+            if ok:
+                fetched += 1
+            else:
+                failures.append(missing[imgSrc])
+    # Evict once for the whole batch rather than after every image
+    evictCachedImages()
+    return 0, fetched, failures
+# END PREFETCHDECKIMAGES
+
+"""
+post: number of image cache hits and misses in this session, and the number and total size of cached images, are printed.
+"""
+def printImageCacheStats():
+    count = 0
+    total = 0
+    if os.path.isdir('data/images'):
+        for entry in os.scandir('data/images'):
+            if entry.name.endswith('.png'):
+                count += 1
+                total += entry.stat().st_size
+    print('Hits: ' + str(imageCacheStats['hits']))
+    print('Misses: ' + str(imageCacheStats['misses']))
+    print('Cached images: ' + str(count) + ' (' + str(total // 1024) + ' KB of ' + str(imageCacheBudget // 1024) + ' KB)')
+# END PRINTIMAGECACHESTATS
 
 """
-pre: file corresponding to param:deckName must exist and have some data in it. If creating a new deck without the use of method:createDeck(), this data can just be '[]'.
+pre: file 'data/oracle.json' must exist.
 param: cardName, name of card matching format of 'name' field of Oracle data.
-param: deckName, name of deck to be added to.
-post: card with name param:cardName is written to file with name corresponding to param:deckName.
-return: -1 if file corresponding to param:deckName does not exist or param:cardName is not found in the cache or Oracle. 
-"""   
-def addToDeck(cardName:str, deckName:str) -> int:
+post: Relevant data from the card with name param:cardName is displayed.
+return: -1 if param:cardName is not found in the cache or Oracle.
+"""
+def printCard(cardName:str) -> int:
     # Lookup target card and return with error if not found
     card = lookupCard(cardName)
     if card == None:
         return -1
+    # Get image content from the image cache or Scryfall and decode it straight from memory
+    content = fetchCardImage(card)
+    if content != None:
+        from PIL import Image
+        img = Image.open(io.BytesIO(content))
+        img.show()
+    # Normal return
+    return 0
+# END PRINTCARD
+
+"""
+param: imgSrc, url of a card image.
+param: width, width in pixels of the thumbnail.
+return: path of the file in folder 'data/thumbs/' followed by param:width caching a thumbnail of the image at param:imgSrc, named after the same hash as the image itself.
+"""
+def getThumbnailPath(imgSrc:str, width:int) -> str:
+    return 'data/thumbs/' + str(width) + '/' + os.path.basename(getImagePath(imgSrc))
+# END GETTHUMBNAILPATH
+
+"""
+param: imgSrc, url of a card image.
+param: width, width in pixels to scale the image down to.
+return: path of a thumbnail of the image at param:imgSrc, or None if the image is not in the image cache, along with the number of bytes written to the thumbnail cache.
+post: a thumbnail missing from the thumbnail cache is decoded from the image cache, scaled down and written to it. Runs in worker processes of method:renderContactSheet(), so it only touches files, and leaves counting its writes to the caller.
+"""
+def makeThumbnail(imgSrc:str, width:int) -> (str, int):
+    from PIL import Image
+    thumbPath = getThumbnailPath(imgSrc, width)
+    imgPath = getImagePath(imgSrc)
+    if not os.path.isfile(imgPath):
+        return None, 0
+    # Refresh modification time so the image is not evicted ahead of ones that are never rendered
+    os.utime(imgPath)
+    if os.path.isfile(thumbPath):
+        return thumbPath, 0
+    with Image.open(imgPath) as img:
+        img = img.convert('RGB')
+        # Shrink by a whole factor with a cheap box reduce before resampling, which is several times faster than resampling from full size
+        img.thumbnail((width, round(width * CARD_ASPECT)), reducing_gap=1.0)
+    os.makedirs(os.path.dirname(thumbPath), exist_ok=True)
+    fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(thumbPath), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        img.save(f, 'PNG', compress_level=1)
+        written = f.tell()
+    os.replace(tempPath, thumbPath)
+    return thumbPath, written
+# END MAKETHUMBNAIL
+
+"""
+pre: file corresponding to param:deckName must exist.
+param: deckName, name of deck to render.
+param: fileName, name of the file to write the contact sheet to, as a PDF if it ends in '.pdf' and as a PNG otherwise.
+param: width, width in pixels of each card tile.
+param: columns, number of card tiles in each row.
+param: workers, number of processes to decode and scale images in, or None for one per CPU.
+post: every card of the deck is drawn once to a grid in file param:fileName, ordered by mana value and then name, with a badge for its quantity when above one. Only images already in the image cache are used, so no request is sent; cards without one are drawn as a placeholder with their name. Thumbnails are cached in folder 'data/thumbs/' by width, and only one thumbnail at a time is held besides the grid.
+return: -1 if file corresponding to param:deckName does not exist, otherwise 0, along with the list of card names drawn as placeholders.
+"""
+def renderContactSheet(deckName:str, fileName:str, width:int=244, columns:int=10, workers:int=None) -> (int, list):
+    from PIL import Image, ImageDraw, ImageFont
+    deck = loadDeck(deckName)
+    if deck == None:
+        return -1, []
+    found, _ = resolveCards(list(deck))
+    names = sorted(deck, key=lambda name: (found.get(normalizeName(name), {}).get('cmc', 0), name))
+    imgSrcs = [getImageURI(found[normalizeName(name)]) if normalizeName(name) in found else None for name in names]
+    # Lay tiles out in a grid with a margin around and between them
+    height = round(width * CARD_ASPECT)
+    margin = max(4, width // 30)
+    rows = max(1, math.ceil(len(names) / columns))
+    cols = max(1, min(columns, len(names)))
+    sheet = Image.new('RGB', (margin + cols * (width + margin), margin + rows * (height + margin)), (32, 32, 32))
+    draw = ImageDraw.Draw(sheet)
+    font = ImageFont.load_default(size=max(10, width // 10))
+    missing = []
+    # Decode and scale each distinct image once across the pool, pasting thumbnails in deck order as they are ready
+    unique = list(dict.fromkeys([imgSrc for imgSrc in imgSrcs if imgSrc != None]))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        futures = dict(zip(unique, [pool.submit(makeThumbnail, imgSrc, width) for imgSrc in unique]))
+        for i in range(len(names)):
+            x = margin + (i % columns) * (width + margin)
+            y = margin + (i // columns) * (height + margin)
+            thumbPath, _ = futures[imgSrcs[i]].result() if imgSrcs[i] != None else (None, 0)
+            if thumbPath != None:
+                with Image.open(thumbPath) as thumb:
+                    sheet.paste(thumb, (x + (width - thumb.width) // 2, y + (height - thumb.height) // 2))
+            else:
+                # Draw a placeholder card holding the name, wrapped to fit the tile
+                missing.append(names[i])
+                draw.rounded_rectangle((x, y, x + width - 1, y + height - 1), radius=width // 20, fill=(90, 90, 90), outline=(160, 160, 160))
+                lines = ['']
+                for word in names[i].split():
+                    if lines[-1] != '' and draw.textlength(lines[-1] + ' ' + word, font=font) > width - 2 * margin:
+                        lines.append(word)
+                    else:
+                        lines[-1] = (lines[-1] + ' ' + word).strip()
+                draw.multiline_text((x + margin, y + margin), '\n'.join(lines), font=font, fill=(240, 240, 240))
+            if deck[names[i]] > 1:
+                # Badge the top right corner with the quantity
+                label = 'x' + str(deck[names[i]])
+                size = round(draw.textlength(label, font=font)) + margin * 2
+                left = x + width - size - margin
+                top = y + margin
+                draw.rounded_rectangle((left, top, left + size, top + font.size + margin * 2), radius=margin, fill=(20, 20, 20), outline=(240, 240, 240))
+                draw.text((left + margin, top + margin), label, font=font, fill=(240, 240, 240))
+        # Workers cannot count into this process's metrics, so count the thumbnails they wrote once each here
+        if metrics != None:
+            for future in futures.values():
+                thumbPath, written = future.result()
+                if written > 0:
+                    countBytes(thumbPath, 'write', written)
+    if fileName.lower().endswith('.pdf'):
+        sheet.save(fileName, 'PDF', resolution=width / 2.5)
+    else:
+        sheet.save(fileName, 'PNG')
+    return 0, missing
+# END RENDERCONTACTSHEET
+
+"""
+param: name, name of the resource to lock, such as 'cache' or 'deck-' followed by a deck name.
+post: an exclusive advisory lock on param:name is held for the body of the with statement, once any other process or thread holding it lets go. Lock files are kept in folder 'data/locks/'. A thread already holding the lock takes it again without waiting. Where neither fcntl nor msvcrt is available, no lock is taken.
+"""
+@contextlib.contextmanager
+def lockFile(name:str):
+    held = getattr(heldLocks, 'names', None)
+    if held == None:
+        held = heldLocks.names = set()
+    if name in held:
+        yield
+        return
+    try:
+        f = open('data/locks/' + name + '.lock', 'a+b')
+    except FileNotFoundError:
+        os.makedirs('data/locks', exist_ok=True)
+        f = open('data/locks/' + name + '.lock', 'a+b')
+    with f:
+        if fcntl != None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        elif msvcrt != None:
+            # Lock the first byte, retrying for as long as another process holds it
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        held.add(name)
+        try:
+            yield
+        finally:
+            held.discard(name)
+            if fcntl != None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            elif msvcrt != None:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+# END LOCKFILE
+
+"""
+param: fileName, name of file to write.
+param: text, new contents of the file.
+post: file param:fileName holds param:text. It is written to a uniquely named file beside it and then swapped in, so readers and a crash never see a partial file and concurrent writers never share a temporary file.
+"""
+def writeFileAtomic(fileName:str, text:str):
+    fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(fileName) or '.', prefix=os.path.basename(fileName) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tempPath, fileName)
+        # Files opened from descriptors bypass the counting open(), so count the write here
+        if metrics != None:
+            countBytes(fileName, 'write', len(text))
+    except BaseException:
+        os.remove(tempPath)
+        raise
+# END WRITEFILEATOMIC
+
+"""
+param: deckName, name of deck.
+return: size and modification time of the file of deck param:deckName, or None if it does not exist.
+"""
+def getDeckStamp(deckName:str) -> list:
+    try:
+        stat = os.stat('data/decks/' + deckName + '.json')
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+# END GETDECKSTAMP
+
+"""
+param: decks, dictionary mapping deck names to their new contents, or to None for decks to delete.
+post: every deck in param:decks is written or deleted.
+"""
+def applyDecks(decks:dict):
+    for deckName, deck in decks.items():
+        if deck == None:
+            if os.path.isfile('data/decks/' + deckName + '.json'):
+                os.remove('data/decks/' + deckName + '.json')
+                updateDeckIndex(deckName, None)
+        else:
+            saveDeck(deckName, deck)
+# END APPLYDECKS
+
+"""
+pre: the lock of every deck in param:decks must be held (see method:lockFile()).
+param: decks, dictionary mapping deck names to their new contents, or to None for decks to delete.
+post: every deck in param:decks is written or deleted. The changes are first logged to the write-ahead log 'data/wal.jsonl', so that if the process dies part way through, method:recoverDecks() finishes them. The log is cleared once they are all applied.
+"""
+def writeDecks(decks:dict):
+    with lockFile('wal'):
+        # Log each deck with the stamp of its file, so recovery can tell which decks are still untouched
+        record = {'decks' : decks, 'stamps' : dict([(deckName, getDeckStamp(deckName)) for deckName in decks])}
+        with open('data/wal.jsonl', 'a', encoding='utf8') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        applyDecks(decks)
+        open('data/wal.jsonl', 'w').close()
+# END WRITEDECKS
+
+"""
+post: changes in the write-ahead log 'data/wal.jsonl' left behind by a process that died part way through method:writeDecks() are applied to every deck not changed since they were logged, and the log is cleared.
+"""
+def recoverDecks():
+    # Read the log under its lock, but let go of it before taking any deck lock, as method:writeDecks() takes them in the other order
+    with lockFile('wal'):
+        try:
+            with open('data/wal.jsonl', encoding='utf8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+    if len(lines) == 0:
+        return
+    for line in lines:
+        # A record cut short was never fully logged, so none of its changes were started
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        with contextlib.ExitStack() as stack:
+            for deckName in sorted(record['decks']):
+                stack.enter_context(lockFile('deck-' + deckName))
+            # Decks whose files have changed since were either already written, or have been changed again since and are left alone
+            applyDecks(dict([(deckName, deck) for deckName, deck in record['decks'].items() if getDeckStamp(deckName) == record['stamps'][deckName]]))
+    with lockFile('wal'):
+        # Clear the log only if no other process has recovered or logged to it in the meantime
+        with open('data/wal.jsonl', encoding='utf8') as f:
+            if f.readlines() == lines:
+                open('data/wal.jsonl', 'w').close()
+# END RECOVERDECKS
+
+"""
+param: deckName, name of deck to be loaded.
+return: dictionary mapping the name of each card in the deck to its quantity, or None if file corresponding to param:deckName does not exist.
+post: a deck stored in the old format of one JSON card object per copy is rewritten in the quantity format.
+"""
+def loadDeck(deckName:str) -> dict:
     # Store path to deck file
     deckPath = 'data/decks/' + deckName + '.json'
     try:
-        with open(deckPath, 'r') as f:
-            # Read deck
-            deck = f.read()
-        with open(deckPath, 'w') as f:
-            # Write back all but closing ']'
-            f.write(deck[0:len(deck)-1])
-        with open(deckPath, 'a') as f:
-            # Add line break unless deck var is empty (would consist only of '[]')
-            if len(deck) > 2:
-                f.write(',\n')
-            # Write in new card
-            json.dump(card, f)
-            # Close deck
-            f.write(']')
-    # Return error code if requested deck DNE
+        with open(deckPath, encoding='utf8') as f:
+            deck = json.load(f)
+    # Return None if requested deck DNE
     except FileNotFoundError:
+        return None
+    # Old decks are a list with a full card object for every copy, so count copies by name
+    if isinstance(deck, list):
+        # Readers reach here without the deck's lock, so take it and read again, in case another process changed the deck in between
+        with lockFile('deck-' + deckName):
+            try:
+                with open(deckPath, encoding='utf8') as f:
+                    deck = json.load(f)
+            except FileNotFoundError:
+                return None
+            if isinstance(deck, list):
+                counts = {}
+                for card in deck:
+                    counts[card['name']] = counts.get(card['name'], 0) + 1
+                deck = counts
+                saveDeck(deckName, deck)
+    return deck
+# END LOADDECK
+
+"""
+param: deckName, name of deck to be saved.
+param: deck, dictionary mapping the name of each card in the deck to its quantity.
+post: file corresponding to param:deckName is atomically replaced with param:deck. The cross-deck index is updated to match (see method:openDeckIndex()).
+"""
+def saveDeck(deckName:str, deck:dict):
+    # Write the new deck beside the old one, then swap it in so a crash never leaves a partial deck
+    writeFileAtomic('data/decks/' + deckName + '.json', json.dumps(deck, indent=0))
+    updateDeckIndex(deckName, deck)
+# END SAVEDECK
+
+"""
+post: the first time this is called, every deck in folder 'data/decks/' stored in the old format of one JSON card object per copy is rewritten in the quantity format, and marker file 'data/decks/_migrated.txt' is created so later starts skip the sweep.
+"""
+def migrateDecks():
+    # Old decks copied in after the sweep are still migrated by method:loadDeck() when first loaded
+    if os.path.isfile('data/decks/_migrated.txt'):
+        return
+    for fileName in os.listdir('data/decks/'):
+        if fileName.endswith('.json'):
+            # Loading a deck migrates it if needed
+            loadDeck(fileName[0:len(fileName)-5])
+    open('data/decks/_migrated.txt', 'w').close()
+# END MIGRATEDECKS
+
+"""
+param: deck, dictionary mapping the name of each card in a deck to its quantity.
+param: cardName, name of card in any case, with or without commas.
+return: name under which param:cardName is stored in param:deck, or None if it is not in param:deck.
+"""
+def findDeckKey(deck:dict, cardName:str) -> str:
+    key = normalizeName(cardName)
+    for name in deck:
+        # Compare target card to each card in deck (non-case-sensitive, ignores commas)
+        if normalizeName(name) == key:
+            return name
+    return None
+# END FINDDECKKEY
+
+"""
+param: deckName, name of deck to be resolved.
+return: list of (slim card record, quantity) pairs for the cards in the deck, looked up through the cache and Oracle, or None if file corresponding to param:deckName does not exist.
+"""
+def resolveDeck(deckName:str) -> list:
+    deck = loadDeck(deckName)
+    if deck == None:
+        return None
+    return [(lookupCard(name), quantity) for name, quantity in deck.items()]
+# END RESOLVEDECK
+
+"""
+pre: file corresponding to param:deckName must exist. If creating a new deck without the use of method:createDeck(), its data can just be '{}'.
+param: cardName, name of card matching format of 'name' field of Oracle data.
+param: deckName, name of deck to be added to.
+post: quantity of card with name param:cardName is incremented in file with name corresponding to param:deckName.
+return: -1 if file corresponding to param:deckName does not exist or param:cardName is not found in the cache or Oracle. 
+"""   
+def addToDeck(cardName:str, deckName:str) -> int:
+    res, _ = commitDeckChanges(deckName, [('add', cardName, 1)])
+    # Report both a missing deck and a missing card as an error
+    if res != 0:
         return -1
     # Normal return
     return 0
 # END ADDTODECK
 
 """
-pre: file corresponding to param:deckName must exist and have some data in it. If creating a new deck without the use of method:createDeck(), this data can just be '[]'.
+pre: file corresponding to param:deckName must exist. If creating a new deck without the use of method:createDeck(), its data can just be '{}'.
 param: cardName, name of card matching format of 'name' field of Oracle data.
 param: deckName, name of deck to be removed from.
-post: card with name param:cardName is written to file with name corresponding to param:deckName.
+post: quantity of card with name param:cardName is decremented in file with name corresponding to param:deckName, and the card is dropped once none are left.
 return: -1 if file corresponding to param:deckName does not exist or param:cardName is not found in the deck. 
 """   
 def removeFromDeck(cardName:str, deckName:str) -> int:
-    # Store path to deck file
-    deckPath = 'data/decks/' + deckName + '.json'
-    try:
-        with open(deckPath, encoding='utf8') as f:
-            # Read deck (as list of dictionaries)
-            deck = json.load(f)
-            deckSize = len(deck)
-        with open(deckPath, 'w') as f:
-            # Clear deck file and write new opener
-            f.write('[')  
-        with open(deckPath, 'a') as f:
-            # Initialize tracking var    
-            found = False
-            # Append each card except the target card back onto the deck
-            for i in range(deckSize):
-                card = deck[i]
-                # Compare target card to each card in deck (non-case-sensitive, ignores commas)
-                if card['name'].lower().replace(",","") == cardName.lower().replace(",","") and not found:
-                    # First instance of target card found is not written back
-                    found = True
-                else:
-                    # Write card
-                    json.dump(card, f)
-                    # Write a newline for every card except the last added
-                    if i != deckSize-1:
-                        f.write(',\n')
-            # Close deck
-            f.write(']')
-            # return with error if target card was not found
-            if not found:
-                return -1
-            # Normal return
-            return 0
-    # Return error code if requested deck DNE
-    except FileNotFoundError:
+    res, _ = commitDeckChanges(deckName, [('remove', cardName, 1)])
+    # Report both a missing deck and a card missing from the deck as an error
+    if res != 0:
         return -1
+    # Normal return
+    return 0
 # END REMOVEFROMDECK
 
+"""
+pre: file 'data/oracle.json' must exist.
+param: cardNames, list of card names matching format of 'name' field of Oracle data. Repeated names are only looked up once.
+return: dictionary mapping the normalized name of each card found to its slim card record, and list of the names that were not found in the cache or Oracle.
+post: cards found are cached if not in cache already.
+"""
+def resolveCards(cardNames:list) -> (dict, list):
+    found = {}
+    misses = []
+    missedKeys = set()
+    for cardName in cardNames:
+        key = normalizeName(cardName)
+        # Skip names already resolved or already reported missing earlier in the list
+        if key in found or key in missedKeys:
+            continue
+        card = lookupCard(cardName)
+        if card == None:
+            misses.append(cardName)
+            missedKeys.add(key)
+        else:
+            found[key] = card
+    return found, misses
+# END RESOLVECARDS
+
+"""
+pre: file corresponding to param:deckName must exist. If creating a new deck without the use of method:createDeck(), its data can just be '{}'.
+param: cardRequests, list of (card name, quantity) pairs, as returned by method:parseCardRequest().
+param: deckName, name of deck to be added to.
+post: every card in param:cardRequests that is found in the cache or Oracle is added to file with name corresponding to param:deckName in its requested quantity, with a single write to the file.
+return: -1 if file corresponding to param:deckName does not exist, otherwise 0, along with the list of card names that were not found or had quantities below 1.
+"""
+def addManyToDeck(cardRequests:list, deckName:str) -> (int, list):
+    # Leave out quantities below 1 up front, as they would roll back the whole commit
+    invalid = [cardName for cardName, quantity in cardRequests if quantity < 1]
+    cardRequests = [(cardName, quantity) for cardName, quantity in cardRequests if quantity >= 1]
+    # Look up every distinct card in one pass, then leave out the misses so the rest still go in
+    _, misses = resolveCards([cardName for cardName, _ in cardRequests])
+    missedKeys = set([normalizeName(cardName) for cardName in misses])
+    changes = [('add', cardName, quantity) for cardName, quantity in cardRequests if normalizeName(cardName) not in missedKeys]
+    res, failures = commitDeckChanges(deckName, changes)
+    return res, misses + invalid + failures
+# END ADDMANYTODECK
+
+"""
+param: deck, dictionary mapping the name of each card in a deck to its quantity.
+param: changes, list of ('add' or 'remove', card name, quantity) triples, applied in order.
+post: the valid changes in param:changes are applied to param:deck.
+return: list of card names whose changes were invalid (cards to add not found in the cache or Oracle, cards to remove not in the deck in the requested quantity, or quantities below 1).
+"""
+def stageDeckChanges(deck:dict, changes:list) -> list:
+    # Look up every distinct card to be added in one pass
+    found, failures = resolveCards([cardName for action, cardName, _ in changes if action == 'add'])
+    # Apply every change against the in-memory deck, in order, so a later change sees the effect of an earlier one
+    for action, cardName, quantity in changes:
+        if quantity < 1:
+            failures.append(cardName)
+        elif action == 'add':
+            card = found.get(normalizeName(cardName))
+            if card != None:
+                # Store card under its name in the Oracle, so differently typed requests share one entry
+                deck[card['name']] = deck.get(card['name'], 0) + quantity
+        else:
+            name = findDeckKey(deck, cardName)
+            if name == None or deck[name] < quantity:
+                failures.append(cardName)
+            else:
+                deck[name] -= quantity
+                # Drop the card once none are left
+                if deck[name] == 0:
+                    del deck[name]
+    return failures
+# END STAGEDECKCHANGES
+
+"""
+pre: file corresponding to param:deckName must exist. If creating a new deck without the use of method:createDeck(), its data can just be '{}'.
+param: deckName, name of deck to be changed.
+param: changes, list of ('add' or 'remove', card name, quantity) triples, applied in order.
+post: if every change in param:changes is valid, they are all applied to file with name corresponding to param:deckName with a single atomic write. Otherwise the file is left untouched.
+return: -1 if file corresponding to param:deckName does not exist, -2 if any change is invalid, otherwise 0, along with the list of card names whose changes were invalid (cards to add not found in the cache or Oracle, cards to remove not in the deck in the requested quantity, or quantities below 1).
+"""
+def commitDeckChanges(deckName:str, changes:list) -> (int, list):
+    # Hold the deck's lock from read to write, so concurrent changes to the same deck are not lost
+    with lockFile('deck-' + deckName):
+        # Read deck and return error code if requested deck DNE
+        deck = loadDeck(deckName)
+        if deck == None:
+            return -1, []
+        # Stage every change against the in-memory deck
+        failures = stageDeckChanges(deck, changes)
+        # Roll back by discarding the staged deck if anything failed
+        if len(failures) > 0:
+            return -2, failures
+        saveDeck(deckName, deck)
+    # Normal return
+    return 0, []
+# END COMMITDECKCHANGES
+
 """
 param: deckName, name of deck to be created.
-post: deck file with name corresponding to param:deckName is created.
+post: deck file with name corresponding to param:deckName is created, and added to the cross-deck index.
 return: -1 if file corresponding to param:deckName already exists. 
 """   
 def createDeck(deckName:str) -> int:
     # Store path to deck file
     deckPath = 'data/decks/' + deckName + '.json'
-    # Return error code if requested deck exists
-    if os.path.isfile(deckPath):
-        return -1
-    # Write new file into existence
-    with open(deckPath, 'w') as f:
-        # Write brackets into new file
-        f.write('[]')
+    with lockFile('deck-' + deckName):
+        # Return error code if requested deck exists
+        if os.path.isfile(deckPath):
+            return -1
+        # Write new file into existence, holding an empty deck
+        writeFileAtomic(deckPath, '{}')
+        updateDeckIndex(deckName, {})
     # Normal return
     return 0
 # END CREATEDECK
 
 """
 param: deckName, name of deck to be deleted.
-post: deck file with name corresponding to param:deckName is deleted.
+post: deck file with name corresponding to param:deckName is deleted, and dropped from the cross-deck index.
 return: -1 if file corresponding to param:deckName does not exists. 
 """   
 def deleteDeck(deckName:str) -> int:
     # Store path to deck file
     deckPath = 'data/decks/' + deckName + '.json'
-    # If deck exists, delete it
-    if os.path.isfile(deckPath):
-        os.remove(deckPath)
-        # Normal return
-        return 0
+    with lockFile('deck-' + deckName):
+        # If deck exists, delete it
+        if os.path.isfile(deckPath):
+            os.remove(deckPath)
+            updateDeckIndex(deckName, None)
+            # Normal return
+            return 0
     # Return error code if requested deck DNE
     return -1
 # END DELETEDECK
@@ -240,107 +1712,310 @@ def printDeckList():
     # Read all files in decks folder
     fileNames = os.listdir('data/decks/')
     for fileName in fileNames:
-        # Exclude the _details file
-        if fileName != '_details.txt':
+        # Exclude the _details file and temporary files of writes in progress
+        if fileName.endswith('.json'):
             # Print current file's name minus the file extension
             nameLength = len(fileName)
             print(fileName[0:nameLength-5])
 # END PRINTDECKLIST
+
+"""
+return: connection to the cross-deck index 'data/deckindex.db', mapping each card to the decks using it, created if missing and brought up to date with folder 'data/decks/' on first use in each process.
+"""
+def openDeckIndex() -> sqlite3.Connection:
+    global deckIndex, deckIndexPid
+    # A connection inherited from a parent process must not be shared with it
+    if deckIndex != None and deckIndexPid == os.getpid():
+        if deckIndexStale:
+            syncDeckIndex()
+        return deckIndex
+    deckIndex = sqlite3.connect('data/deckindex.db', timeout=30, check_same_thread=False)
+    deckIndexPid = os.getpid()
+    # Write-ahead journaling lets readers carry on while another process updates the index
+    deckIndex.execute('PRAGMA journal_mode = WAL')
+    deckIndex.execute('PRAGMA synchronous = NORMAL')
+    with deckIndex:
+        deckIndex.execute('CREATE TABLE IF NOT EXISTS decks (deck TEXT PRIMARY KEY, size INTEGER, fileSize INTEGER, fileTime INTEGER)')
+        deckIndex.execute('CREATE TABLE IF NOT EXISTS deck_cards (deck TEXT, key TEXT, name TEXT, quantity INTEGER, PRIMARY KEY (deck, key))')
+        deckIndex.execute('CREATE INDEX IF NOT EXISTS deck_cards_key ON deck_cards (key)')
+    syncDeckIndex()
+    return deckIndex
+# END OPENDECKINDEX
+
+"""
+param: conn, connection to the cross-deck index.
+param: deckName, name of deck.
+param: deck, dictionary mapping the name of each card in the deck to its quantity, or None if the deck no longer exists.
+post: rows of deck param:deckName in the cross-deck index are replaced with those of param:deck, stamped with the deck file's current size and modification time.
+"""
+def indexDeck(conn:sqlite3.Connection, deckName:str, deck:dict):
+    conn.execute('DELETE FROM deck_cards WHERE deck = ?', (deckName,))
+    conn.execute('DELETE FROM decks WHERE deck = ?', (deckName,))
+    stamp = getDeckStamp(deckName)
+    if deck == None or stamp == None:
+        return
+    rows = aggregateDeck(deck)
+    conn.executemany('INSERT INTO deck_cards VALUES (?, ?, ?, ?)', [(deckName, normalizeName(cardName), cardName, quantity) for cardName, quantity in rows])
+    conn.execute('INSERT INTO decks VALUES (?, ?, ?, ?)', (deckName, sum([quantity for _, quantity in rows]), stamp[0], stamp[1]))
+# END INDEXDECK
+
+"""
+post: the cross-deck index is brought up to date with folder 'data/decks/' in a single transaction: decks whose files changed outside this tool are indexed again, new decks are added and missing decks are dropped. Only the decks that differ are read. If the calling thread holds any lock, the index is instead marked stale, to be synced on its next use.
+"""
+def syncDeckIndex():
+    global deckIndexStale
+    # Taking deck locks while this thread holds others could deadlock against a process taking them in another order, so leave the sync to the next use with no locks held
+    if len(getattr(heldLocks, 'names', set())) > 0:
+        deckIndexStale = True
+        return
+    stamps = dict([(row[0], [row[1], row[2]]) for row in deckIndex.execute('SELECT deck, fileSize, fileTime FROM decks')])
+    # Read each changed deck along with its stamp under the deck's lock, so the two match, before the transaction starts
+    changed = []
+    for entry in os.scandir('data/decks'):
+        if not entry.name.endswith('.json'):
+            continue
+        deckName = entry.name[0:len(entry.name)-5]
+        stat = entry.stat()
+        if stamps.pop(deckName, None) != [stat.st_size, stat.st_mtime_ns]:
+            with lockFile('deck-' + deckName):
+                changed.append((deckName, loadDeck(deckName), getDeckStamp(deckName)))
+    for deckName in stamps:
+        changed.append((deckName, None, None))
+    # Apply every change in one transaction, passing over decks written since they were read, which index themselves
+    with deckIndex:
+        for deckName, deck, stamp in changed:
+            if getDeckStamp(deckName) == stamp:
+                indexDeck(deckIndex, deckName, deck)
+    deckIndexStale = False
+# END SYNCDECKINDEX
+
+"""
+param: deckName, name of deck that was written or deleted.
+param: deck, new contents of the deck, or None if it was deleted.
+post: the cross-deck index reflects the change. If the index cannot be written, it is brought up to date from the deck files on its next use instead.
+"""
+def updateDeckIndex(deckName:str, deck:dict):
+    global deckIndexStale
+    try:
+        conn = openDeckIndex()
+        with conn:
+            indexDeck(conn, deckName, deck)
+    except sqlite3.Error:
+        deckIndexStale = True
+# END UPDATEDECKINDEX
+
+"""
+param: cardName, name of card in any case, with or without commas.
+return: list of (deck name, quantity) pairs for every deck using the card, most copies first.
+"""
+def cardUsage(cardName:str) -> list:
+    rows = openDeckIndex().execute('SELECT deck, quantity FROM deck_cards WHERE key = ? ORDER BY quantity DESC, deck', (normalizeName(cardName),))
+    return [(deckName, quantity) for deckName, quantity in rows]
+# END CARDUSAGE
+
+"""
+param: deckName, name of the deck to compare from.
+param: otherName, name of the deck to compare to.
+return: list of (card name, quantity in param:deckName, quantity in param:otherName) triples for every card whose quantity differs between the decks, ordered by name, or None if either deck does not exist.
+"""
+def diffDecks(deckName:str, otherName:str) -> list:
+    conn = openDeckIndex()
+    if conn.execute('SELECT COUNT(*) FROM decks WHERE deck IN (?, ?)', (deckName, otherName)).fetchone()[0] < len(set([deckName, otherName])):
+        return None
+    counts = {}
+    for deck, key, cardName, quantity in conn.execute('SELECT deck, key, name, quantity FROM deck_cards WHERE deck IN (?, ?)', (deckName, otherName)):
+        entry = counts.setdefault(key, [cardName, 0, 0])
+        entry[1 if deck == deckName else 2] += quantity
+    return sorted([tuple(entry) for entry in counts.values() if entry[1] != entry[2]])
+# END DIFFDECKS
+
+"""
+param: deckName, name of deck to find similar decks to.
+param: limit, maximum number of decks to return.
+return: list of (deck name, similarity) pairs for the decks sharing the most with param:deckName, most similar first, or None if the deck does not exist. Similarity is the weighted Jaccard index of the decks' card counts: the copies they share over the copies in either, from 0 to 1.
+"""
+def similarDecks(deckName:str, limit:int=10) -> list:
+    conn = openDeckIndex()
+    row = conn.execute('SELECT size FROM decks WHERE deck = ?', (deckName,)).fetchone()
+    if row == None:
+        return None
+    size = row[0]
+    # Only decks sharing at least one card with the deck are scored, found through the index on card keys
+    rows = conn.execute('SELECT other.deck, SUM(MIN(mine.quantity, other.quantity)), decks.size FROM deck_cards AS mine JOIN deck_cards AS other ON other.key = mine.key AND other.deck != mine.deck JOIN decks ON decks.deck = other.deck WHERE mine.deck = ? GROUP BY other.deck', (deckName,))
+    scores = [(otherName, shared / (size + otherSize - shared)) for otherName, shared, otherSize in rows]
+    scores.sort(key=lambda score: (-score[1], score[0]))
+    return scores[0:limit]
+# END SIMILARDECKS
+
+"""
+param: deckName, name of deck to copy.
+param: newName, name of the copy.
+post: file of deck param:deckName is copied byte for byte to a new deck named param:newName, without being parsed, and its rows in the cross-deck index are copied with it.
+return: -1 if deck param:deckName does not exist, -2 if deck param:newName already exists.
+"""
+def cloneDeck(deckName:str, newName:str) -> int:
+    global deckIndexStale
+    with contextlib.ExitStack() as stack:
+        # Take the deck locks in name order, as a batch would
+        for name in sorted(set([deckName, newName])):
+            stack.enter_context(lockFile('deck-' + name))
+        deckPath = 'data/decks/' + deckName + '.json'
+        newPath = 'data/decks/' + newName + '.json'
+        if not os.path.isfile(deckPath):
+            return -1
+        if os.path.isfile(newPath):
+            return -2
+        fd, tempPath = tempfile.mkstemp(dir='data/decks', prefix=newName + '.json.', suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(deckPath, tempPath)
+        os.replace(tempPath, newPath)
+        try:
+            conn = openDeckIndex()
+            row = conn.execute('SELECT fileSize, fileTime FROM decks WHERE deck = ?', (deckName,)).fetchone()
+            # Copy the source's rows if they are current, and read the copy otherwise
+            if row == None or list(row) != getDeckStamp(deckName):
+                with conn:
+                    indexDeck(conn, newName, loadDeck(newName))
+            else:
+                stamp = getDeckStamp(newName)
+                with conn:
+                    conn.execute('DELETE FROM deck_cards WHERE deck = ?', (newName,))
+                    conn.execute('DELETE FROM decks WHERE deck = ?', (newName,))
+                    conn.execute('INSERT INTO deck_cards SELECT ?, key, name, quantity FROM deck_cards WHERE deck = ?', (newName, deckName))
+                    conn.execute('INSERT INTO decks SELECT ?, size, ?, ? FROM decks WHERE deck = ?', (newName, stamp[0], stamp[1], deckName))
+        except sqlite3.Error:
+            deckIndexStale = True
+    # Normal return
+    return 0
+# END CLONEDECK
             
 
+"""
+param: deck, dictionary mapping the name of each card in a deck to its quantity.
+return: list of (card name, quantity) pairs sorted alphabetically by card name, with entries whose names only differ in case or commas counted together.
+"""
+def aggregateDeck(deck:dict) -> list:
+    # Count by normalized name in a single pass, keeping the first spelling seen for each card
+    counts = {}
+    for cardName, quantity in deck.items():
+        entry = counts.get(normalizeName(cardName))
+        if entry == None:
+            counts[normalizeName(cardName)] = [cardName, quantity]
+        else:
+            entry[1] += quantity
+    return sorted([(cardName, quantity) for cardName, quantity in counts.values()])
+# END AGGREGATEDECK
+
 """
 param: deckName, name of deck to be printed.
 post: deck file with name corresponding to param:deckName is printed.
 return: -1 if file corresponding to param:deckName does not exist. 
 """   
 def printDeck(deckName:str) -> int:
-    # Store path to deck file
-    deckPath = 'data/decks/' + deckName + '.json'
-    try:
-        with open(deckPath, encoding='utf8') as f:
-            # Initialize list of card dictonaries
-            cardDicts = []
-            # Read deck (as list of dictionaries)
-            deck = json.load(f)
-            # Print number of cards in deck
-            print(str(len(deck)) + ' cards\n')
-            for card in deck:
-                # Store name of current card
-                cardName = card['name']
-                # Initialize tracking var for each card
-                found = False
-                for cardDict in cardDicts:
-                    # Compare current card to each card in list of card dictionaries (non-case-sensitive, ignores commas)
-                    if cardDict.get('name').lower().replace(",","") == cardName.lower().replace(",",""):
-                        # If card name is already in list of dictionaries, increment quantity for that name
-                        cardDict.update({'quantity' : cardDict.get('quantity')+1})
-                        found = True
-                if not found:
-                    # If card name is not already in list of dictionaries, add it with a quantity of 1
-                    cardDicts.append({'name' : cardName, 'quantity' : 1})
-            # Sort completed list of dictionaries alphabetically by card name
-            cardDicts.sort(key=lambda e : e['name'])
-            for i in range(len(cardDicts)):
-                # print current dictionary name and quantity (if quantity > 1)
-                print(cardDicts[i].get('name'), end="")
-                quantity = cardDicts[i].get('quantity')
-                if quantity > 1:
-                    print(" x" + str(quantity))
-                else:
-                    print("")
-            # Normal return
-            return 0
-    # Return error code if requested deck DNE
-    except FileNotFoundError:
+    # Read deck and return error code if requested deck DNE
+    deck = loadDeck(deckName)
+    if deck == None:
         return -1
+    # Print number of cards in deck
+    print(str(sum(deck.values())) + ' cards\n')
+    for cardName, quantity in aggregateDeck(deck):
+        # print current card name and quantity (if quantity > 1)
+        print(cardName, end="")
+        if quantity > 1:
+            print(" x" + str(quantity))
+        else:
+            print("")
+    # Normal return
+    return 0
 # END PRINTDECK
     
+"""
+param: deck, dictionary mapping the name of each card in a deck to its quantity.
+param: fmt, decklist format, one of the keys of var:EXPORT_FORMATS.
+return: generator of the lines of param:deck written out in format param:fmt, each ending in a line break.
+"""
+def iterDeckLines(deck:dict, fmt:str):
+    if fmt == 'csv':
+        # Reuse one small buffer to let the csv module handle quoting line by line
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(['Count', 'Name'])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    elif fmt == 'arena':
+        yield 'Deck\n'
+    for cardName, quantity in aggregateDeck(deck):
+        if fmt == 'default':
+            # Card name, followed by quantity if quantity > 1
+            if quantity > 1:
+                yield cardName + ' x' + str(quantity) + '\n'
+            else:
+                yield cardName + '\n'
+        elif fmt == 'plain':
+            yield str(quantity) + ' ' + cardName + '\n'
+        elif fmt == 'mtgo':
+            # MTGO writes the halves of split cards with a single slash
+            yield str(quantity) + ' ' + cardName.replace(' // ', '/') + '\n'
+        elif fmt == 'arena':
+            # Arena wants the printing of each card, so resolve it through the card store
+            card = lookupCard(cardName)
+            if card == None:
+                yield str(quantity) + ' ' + cardName + '\n'
+                continue
+            # Arena only names the front face of double-faced and adventure cards
+            if card.get('layout') not in ('split', 'aftermath', 'fuse'):
+                cardName = cardName.split(' // ')[0]
+            yield str(quantity) + ' ' + cardName + ' (' + card['set'].upper() + ') ' + card['collector_number'] + '\n'
+        elif fmt == 'csv':
+            writer.writerow([quantity, cardName])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+# END ITERDECKLINES
+
 """
 param: deckName, name of deck to be exported.
 param: fileName, name of file to be exported to.
-post: deck file with name corresponding to param:deckName is exported.
-return: -1 if file corresponding to param:deckName does not exist. 
+param: fmt, decklist format, one of the keys of var:EXPORT_FORMATS.
+post: deck file with name corresponding to param:deckName is exported, one line at a time.
+return: -1 if file corresponding to param:deckName does not exist or param:fileName cannot be created, -2 if param:fmt is not a known format.
 """   
-def exportDeck(deckName:str, fileName:str) -> int:
-    # Store path to deck file
-    deckPath = 'data/decks/' + deckName + '.json'
+def exportDeck(deckName:str, fileName:str, fmt:str='default') -> int:
+    # Return error code if requested format DNE
+    if fmt not in EXPORT_FORMATS:
+        return -2
+    # Read deck and return error code if requested deck DNE
+    deck = loadDeck(deckName)
+    if deck == None:
+        return -1
     try:
-        with open(deckPath, encoding='utf8') as f:
-            with open(fileName, 'w') as dest:
-                # Initialize list of card dictonaries
-                cardDicts = []
-                # Read deck (as list of dictionaries)
-                deck = json.load(f)
-                for card in deck:
-                    # Store name of current card
-                    cardName = card['name']
-                    # Initialize tracking var for each card
-                    found = False
-                    for cardDict in cardDicts:
-                        # Compare current card to each card in list of card dictionaries (non-case-sensitive, ignores commas)
-                        if cardDict.get('name').lower().replace(",","") == cardName.lower().replace(",",""):
-                            # If card name is already in list of dictionaries, increment quantity for that name
-                            cardDict.update({'quantity' : cardDict.get('quantity')+1})
-                            found = True
-                    if not found:
-                        # If card name is not already in list of dictionaries, add it with a quantity of 1
-                        cardDicts.append({'name' : cardName, 'quantity' : 1})
-                # Sort completed list of dictionaries alphabetically by card name
-                cardDicts.sort(key=lambda e : e['name'])
-                for i in range(len(cardDicts)):
-                    # write current dictionary name and quantity (if quantity > 1) to destination file
-                    dest.write(cardDicts[i].get('name'))
-                    quantity = cardDicts[i].get('quantity')
-                    if quantity > 1:
-                        dest.write(" x" + str(quantity) + '\n')
-                    else:
-                        dest.write('\n')
-                # Normal return
-                return 0
-    # Return error code if requested deck or destination file DNE
+        with open(fileName, 'w', encoding='utf8', newline='') as dest:
+            # Stream each line to the destination file as it is produced
+            for line in iterDeckLines(deck, fmt):
+                dest.write(line)
+            # Normal return
+            return 0
+    # Return error code if destination file DNE
     except FileNotFoundError:
         return -1
 # END EXPORTDECK
+
+"""
+param: deckNames, names of decks to be exported.
+param: folderName, name of existing folder to export to. Each deck is written to a file named after it.
+param: fmt, decklist format, one of the keys of var:EXPORT_FORMATS.
+post: every deck in param:deckNames is exported to param:folderName.
+return: list of the names of decks that could not be exported.
+"""
+def exportDecks(deckNames:list, folderName:str, fmt:str='default') -> list:
+    failures = []
+    for deckName in deckNames:
+        res = exportDeck(deckName, os.path.join(folderName, deckName + EXPORT_FORMATS.get(fmt, '')), fmt)
+        if res != 0:
+            failures.append(deckName)
+    return failures
+# END EXPORTDECKS
     
 """
 pre: file 'data/decks/_details.txt' must exist and have its first character be a digit representing the number of default-named decks that currently exist. Currently allows for only 9.
@@ -363,95 +2038,675 @@ pre: file 'data/decks/_details.txt' must exist and have its first character be a
 post: increments the digit stored in file 'data/decks/_details.txt' representing the number of default-named decks in existence.
 """   
 def incDefaultDeckName():
-    with open('data/decks/_details.txt', 'r') as f:
-        # Read details
-        details = f.read()
-        # Store first digit of details
-        n = details[0]
-    with open('data/decks/_details.txt', 'w') as f:
+    # Hold the details lock from read to write, so two processes creating default-named decks both count
+    with lockFile('details'):
+        with open('data/decks/_details.txt', 'r') as f:
+            # Read details
+            details = f.read()
+            # Store first digit of details
+            n = details[0]
         # Increment
         n = str(int(n) + 1)
         # Write back details with new first digit
-        f.write(n + details[1:len(details)])
+        writeFileAtomic('data/decks/_details.txt', n + details[1:len(details)])
 # END INCDEFAULTDECKNAME
 
 """
-pre: file 'data/decks/_details.txt' must exist and have all but its first character representing the name of the deck last referenced by the user, or the default if no deck has been referenced.
-return: returns the string stored in in file 'data/decks/_details.txt' representing the name of the deck last referenced by the user, or the default if no deck has been referenced.
-"""   
-def getRecentDeckName() -> str:
-    # Initialize deck name
-    deckName = ''
-    with open('data/decks/_details.txt', 'r') as f:
-        # Read details
-        details = f.read()
-        # Set deck name to be all but the first digit of details
-        deckName = details[1:len(details)]
-    # Return
-    return deckName
-# END GETRECENTDECKNAME
+return: path of the file holding the state of the user running this process, such as the deck they last referenced, in folder 'data/users/'.
+"""
+def getUserStatePath() -> str:
+    try:
+        user = getpass.getuser()
+    except Exception:
+        user = 'default'
+    # Keep the user name safe to use as a file name
+    user = re.sub(r'[^A-Za-z0-9_.-]', '_', user)
+    return 'data/users/' + user + '.txt'
+# END GETUSERSTATEPATH
+
+"""
+pre: file 'data/decks/_details.txt' must exist.
+return: name of the deck last referenced by the user running this process, as stored by method:updateRecentDeck(). Falls back on the name stored after the first character of file 'data/decks/_details.txt' by earlier versions, shared by every user.
+"""   
+def getRecentDeckName() -> str:
+    try:
+        with open(getUserStatePath(), 'r', encoding='utf8') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    # Initialize deck name
+    deckName = ''
+    with open('data/decks/_details.txt', 'r') as f:
+        # Read details
+        details = f.read()
+        # Set deck name to be all but the first digit of details
+        deckName = details[1:len(details)]
+    # Return
+    return deckName
+# END GETRECENTDECKNAME
+
+"""
+param: deckName, name of deck to be referenced in the future.
+post: name of the deck last referenced by the user running this process is stored as param:deckName in their own file in folder 'data/users/', so users sharing the data folder do not overwrite each other's.
+"""   
+def updateRecentDeck(deckName:str):
+    os.makedirs('data/users', exist_ok=True)
+    writeFileAtomic(getUserStatePath(), deckName)
+# END UPDATERECENTDECK
+
+"""
+pre: file corresponding to param:deckName must exist. If creating a new deck without the use of method:createDeck(), its data can just be '{}'.
+param: deckName, name of deck to goldfish with.
+post: list seven random cards from the deck of name param:deckName
+return: -1 if file corresponding to param:deckName does not exist. 
+"""   
+def goldfish(deckName:str) -> int:
+    # Read deck and return error code if requested deck DNE
+    counts = loadDeck(deckName)
+    if counts == None:
+        return -1
+    # Expand deck into one name per copy
+    deck = [name for name, quantity in counts.items() for _ in range(quantity)]
+    # Initialize list of unique random indices of the deck
+    uniqueRandIndices = []
+    # Store deck size
+    numCards = len(deck)
+    # Initialize starting hand size
+    handSize = 7
+    # Reduce starting hand size if deck is too small
+    if handSize > numCards:
+        handSize = numCards
+    # Generate a number of random indices of the deck equal to the hand size
+    for _ in range(0,handSize):
+        # Initialize random index
+        randIndex = -1
+        # Generate a random index of the deck until one that has not been stored already is generated
+        while randIndex in uniqueRandIndices or randIndex == -1:
+            randIndex = rng.randint(0,numCards-1)
+        # Store random index
+        uniqueRandIndices.append(randIndex)
+    # Initialize hand
+    hand = []
+    # Load cards into hand using list of random indices of the deck
+    for i in uniqueRandIndices:
+        hand.append(deck[i])
+    # Print cards in hand    
+    print(hand)
+    # Normal return
+    return 0
+# END GOLDFISH
+
+"""
+param: deckSize, number of cards in the deck.
+param: turn, turn number, starting from 1.
+param: onDraw, whether the player draws a card on their first turn.
+return: number of cards seen by the given turn: the opening hand of seven plus one draw per turn, skipping the first draw on the play.
+"""
+def getCardsSeen(deckSize:int, turn:int, onDraw:bool) -> int:
+    seen = 7 + turn - 1
+    if onDraw:
+        seen += 1
+    return min(seen, deckSize)
+# END GETCARDSSEEN
+
+"""
+param: population, number of cards in the deck.
+param: successes, number of copies of the cards of interest in the deck.
+param: draws, number of cards drawn.
+param: k, number of cards of interest drawn.
+return: exact probability of drawing exactly param:k cards of interest.
+"""
+def hypergeometric(population:int, successes:int, draws:int, k:int) -> float:
+    return math.comb(successes, k) * math.comb(population-successes, draws-k) / math.comb(population, draws)
+# END HYPERGEOMETRIC
+
+"""
+param: cardIds, deck as a list with one integer card id per copy.
+param: landIds, ids of the cards that are lands.
+param: curveIds, list holding, for each turn, the ids of the nonland cards whose cmc equals that turn.
+param: targetIds, list holding, for each tracked card, its id, or -1 if it is not in the deck.
+param: trials, number of games to simulate.
+param: turns, number of turns to follow each game for.
+param: onDraw, whether the player draws a card on their first turn.
+param: minLands, fewest lands in a keepable opening hand.
+param: maxLands, most lands in a keepable opening hand.
+param: seed, seed for the random number generator, or None to seed from the system.
+return: counts over all trials: games for each number of lands in the opening hand, games to mulligan, and games that by each turn have made every land drop, have a curve piece for that turn, and hold each tracked card.
+"""
+def countGoldfishTrials(cardIds:list, landIds:list, curveIds:list, targetIds:list, trials:int, turns:int, onDraw:bool, minLands:int, maxLands:int, seed:int) -> dict:
+    import numpy as np
+    generator = np.random.default_rng(seed)
+    deck = np.array(cardIds, dtype=np.int32)
+    numIds = int(deck.max()) + 1
+    deckSize = len(deck)
+    handSize = min(7, deckSize)
+    maxSeen = getCardsSeen(deckSize, turns, onDraw)
+    # Per-id lookup tables, so each drawn id maps straight to its properties
+    isLand = np.zeros(numIds, dtype=bool)
+    isLand[landIds] = True
+    isCurve = np.zeros((turns, numIds), dtype=bool)
+    for t in range(turns):
+        isCurve[t, curveIds[t]] = True
+    counts = {'handLands' : np.zeros(handSize+1, dtype=np.int64), 'mulligans' : 0, 'landDrops' : np.zeros(turns, dtype=np.int64), 'curve' : np.zeros(turns, dtype=np.int64), 'targets' : np.zeros((len(targetIds), turns), dtype=np.int64)}
+    # Simulate in batches to bound memory
+    batchSize = 20000
+    done = 0
+    while done < trials:
+        size = min(batchSize, trials - done)
+        done += size
+        # Sorting random keys gives one shuffled order of the deck per game, of which only the cards seen are kept
+        order = np.argsort(generator.random((size, deckSize)), axis=1)[:, 0:maxSeen]
+        drawn = deck[order]
+        lands = isLand[drawn]
+        handLands = lands[:, 0:handSize].sum(axis=1)
+        counts['handLands'] += np.bincount(handLands, minlength=handSize+1)
+        counts['mulligans'] += int(((handLands < minLands) | (handLands > maxLands)).sum())
+        landsSeen = np.cumsum(lands, axis=1)
+        for t in range(turns):
+            seen = getCardsSeen(deckSize, t+1, onDraw)
+            counts['landDrops'][t] += int((landsSeen[:, seen-1] >= t+1).sum())
+            counts['curve'][t] += int(isCurve[t][drawn[:, 0:seen]].any(axis=1).sum())
+        for j in range(len(targetIds)):
+            if targetIds[j] == -1:
+                continue
+            # A card is held by a turn once its first copy has been seen
+            held = np.logical_or.accumulate(drawn == targetIds[j], axis=1)
+            for t in range(turns):
+                counts['targets'][j, t] += int(held[:, getCardsSeen(deckSize, t+1, onDraw)-1].sum())
+    return {key : (value.tolist() if hasattr(value, 'tolist') else value) for key, value in counts.items()}
+# END COUNTGOLDFISHTRIALS
+
+"""
+pre: file corresponding to param:deckName must exist.
+param: deckName, name of deck to simulate.
+param: trials, number of games to simulate.
+param: turns, number of turns to follow each game for.
+param: targets, names of cards to track the chance of holding.
+param: onDraw, whether the player draws a card on their first turn.
+param: minLands, fewest lands in a keepable opening hand.
+param: maxLands, most lands in a keepable opening hand.
+param: workers, number of processes to spread the trials over.
+param: seed, seed for the random number generator, or None to seed from the system.
+return: simulated and exact probabilities of each number of lands in the opening hand, of a mulligan, and by each turn of having made every land drop, holding a nonland card of cmc equal to the turn, and holding each card in param:targets, or None if file corresponding to param:deckName does not exist.
+"""
+def simulateGoldfish(deckName:str, trials:int=100000, turns:int=4, targets:list=[], onDraw:bool=False, minLands:int=2, maxLands:int=5, workers:int=1, seed:int=None) -> dict:
+    deck = loadDeck(deckName)
+    if deck == None or sum(deck.values()) == 0:
+        return None
+    # Encode the deck as one integer id per copy, with lookup lists of which ids are lands and curve pieces
+    found, _ = resolveCards(list(deck))
+    names = sorted(deck)
+    cardIds = []
+    landIds = []
+    curveIds = [[] for _ in range(turns)]
+    for i in range(len(names)):
+        cardIds += [i] * deck[names[i]]
+        card = found.get(normalizeName(names[i]), {})
+        if 'Land' in card.get('type_line', ''):
+            landIds.append(i)
+        elif int(card.get('cmc', 0)) in range(1, turns+1):
+            curveIds[int(card['cmc'])-1].append(i)
+    targetIds = []
+    for target in targets:
+        name = findDeckKey(deck, target)
+        targetIds.append(names.index(name) if name != None else -1)
+    args = (cardIds, landIds, curveIds, targetIds)
+    if workers <= 1:
+        counts = countGoldfishTrials(*args, trials, turns, onDraw, minLands, maxLands, seed)
+    else:
+        # Give each process its share of the trials and its own seed, then add up their counts
+        shares = [trials // workers + (1 if i < trials % workers else 0) for i in range(workers)]
+        seeds = [None if seed == None else seed + i for i in range(workers)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(countGoldfishTrials, *args, shares[i], turns, onDraw, minLands, maxLands, seeds[i]) for i in range(workers)]
+            parts = [future.result() for future in futures]
+        counts = parts[0]
+        for part in parts[1:]:
+            counts['handLands'] = [a + b for a, b in zip(counts['handLands'], part['handLands'])]
+            counts['mulligans'] += part['mulligans']
+            for key in ['landDrops', 'curve']:
+                counts[key] = [a + b for a, b in zip(counts[key], part[key])]
+            counts['targets'] = [[a + b for a, b in zip(rowA, rowB)] for rowA, rowB in zip(counts['targets'], part['targets'])]
+    # Work out exact hypergeometric results to check the simulation against
+    deckSize = len(cardIds)
+    handSize = min(7, deckSize)
+    numLands = sum([deck[names[i]] for i in landIds])
+    exactHandLands = [hypergeometric(deckSize, numLands, handSize, k) for k in range(handSize+1)]
+    exactLandDrops = []
+    for t in range(1, turns+1):
+        seen = getCardsSeen(deckSize, t, onDraw)
+        exactLandDrops.append(sum([hypergeometric(deckSize, numLands, seen, k) for k in range(t, min(seen, numLands)+1)]))
+    exactTargets = []
+    for j in range(len(targets)):
+        copies = deck[names[targetIds[j]]] if targetIds[j] != -1 else 0
+        exactTargets.append([1 - hypergeometric(deckSize, copies, getCardsSeen(deckSize, t, onDraw), 0) for t in range(1, turns+1)])
+    curveCopies = [sum([deck[names[i]] for i in curveIds[t]]) for t in range(turns)]
+    return {
+        'trials' : trials,
+        'handLands' : [n / trials for n in counts['handLands']],
+        'exactHandLands' : exactHandLands,
+        'mulligan' : counts['mulligans'] / trials,
+        'exactMulligan' : sum([exactHandLands[k] for k in range(handSize+1) if k < minLands or k > maxLands]),
+        'landDrops' : [n / trials for n in counts['landDrops']],
+        'exactLandDrops' : exactLandDrops,
+        'curve' : [n / trials for n in counts['curve']],
+        'exactCurve' : [1 - hypergeometric(deckSize, curveCopies[t], getCardsSeen(deckSize, t+1, onDraw), 0) for t in range(turns)],
+        'targets' : {targets[j] : [n / trials for n in counts['targets'][j]] for j in range(len(targets))},
+        'exactTargets' : {targets[j] : exactTargets[j] for j in range(len(targets))}
+    }
+# END SIMULATEGOLDFISH
+
+"""
+param: stats, results of method:simulateGoldfish().
+post: simulated probabilities are printed beside their exact values.
+"""
+def printGoldfishStats(stats:dict):
+    print('Simulated ' + str(stats['trials']) + ' games (simulated / exact)')
+    print('Lands in opening hand:')
+    for k in range(len(stats['handLands'])):
+        print('  ' + str(k) + ': ' + format(stats['handLands'][k], '.2%') + ' / ' + format(stats['exactHandLands'][k], '.2%'))
+    print('Mulligan: ' + format(stats['mulligan'], '.2%') + ' / ' + format(stats['exactMulligan'], '.2%'))
+    for t in range(len(stats['landDrops'])):
+        print('Turn ' + str(t+1) + ':')
+        print('  Made every land drop: ' + format(stats['landDrops'][t], '.2%') + ' / ' + format(stats['exactLandDrops'][t], '.2%'))
+        print('  Holding a ' + str(t+1) + '-drop: ' + format(stats['curve'][t], '.2%') + ' / ' + format(stats['exactCurve'][t], '.2%'))
+        for target in stats['targets']:
+            print('  Holding ' + target + ': ' + format(stats['targets'][target][t], '.2%') + ' / ' + format(stats['exactTargets'][target][t], '.2%'))
+# END PRINTGOLDFISHSTATS
+
+"""
+param: card, JSON card object.
+return: number of mana symbols of each color in the mana cost of param:card, in WUBRG order. Hybrid symbols count toward each of their colors.
+"""
+def getColorPips(card:dict) -> list:
+    manaCost = card.get('mana_cost')
+    # Double-faced cards only carry mana costs on their faces, so count the front face
+    if manaCost == None and len(card.get('card_faces', [])) > 0:
+        manaCost = card['card_faces'][0].get('mana_cost', '')
+    pips = [0, 0, 0, 0, 0]
+    for symbol in re.findall(r'\{([^}]*)\}', manaCost or ''):
+        for i in range(5):
+            if 'WUBRG'[i] in symbol:
+                pips[i] += 1
+    return pips
+# END GETCOLORPIPS
+
+"""
+param: value, power or toughness of a card as written in the Oracle.
+return: param:value as a number, or NaN if it is missing or not a plain number (e.g. '*' or '1+*').
+"""
+def parseStat(value:str) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+# END PARSESTAT
+
+"""
+pre: file 'data/oracle.json' must exist.
+post: file 'data/columns.npz' holds one NumPy array per card attribute, with every card in the Oracle at a dense id given by its position: normalized name, cmc, color and color identity bitmasks, color pips, type flags (see var:CARD_TYPES), power, toughness and legality bits (see the 'formats' array).
+return: the new columns.
+"""
+def buildCardColumns() -> dict:
+    global cardColumns
+    import numpy as np
+    keys = []
+    cmc = []
+    colors = []
+    identity = []
+    pips = []
+    types = []
+    power = []
+    toughness = []
+    legalities = []
+    seen = set()
+    for card in streamOracle():
+        key = normalizeName(card['name'])
+        # Keep one entry per name, matching the name index
+        if key in seen:
+            continue
+        seen.add(key)
+        keys.append(key)
+        cmc.append(card.get('cmc', 0))
+        colors.append(getColorMask(getColorString(card)))
+        identity.append(getColorMask(card.get('color_identity', [])))
+        pips.append(getColorPips(card))
+        typeLine = card.get('type_line', '')
+        flags = 0
+        for i in range(len(CARD_TYPES)):
+            if CARD_TYPES[i] in typeLine:
+                flags |= 1 << i
+        types.append(flags)
+        # Use the front face's stats for double-faced creatures
+        face = card
+        if 'power' not in card and len(card.get('card_faces', [])) > 0:
+            face = card['card_faces'][0]
+        power.append(parseStat(face.get('power')))
+        toughness.append(parseStat(face.get('toughness')))
+        legalities.append(card.get('legalities', {}))
+    # Give each format seen in the Oracle one bit
+    formats = sorted(set([fmt for legality in legalities for fmt in legality]))
+    legal = [sum([1 << i for i in range(len(formats)) if legality.get(formats[i]) == 'legal']) for legality in legalities]
+    columns = {
+        'oracle' : np.array(getOracleStamp(), dtype=np.int64),
+        'keys' : np.array(keys, dtype=str),
+        'cmc' : np.array(cmc, dtype=np.float32),
+        'colors' : np.array(colors, dtype=np.uint8),
+        'identity' : np.array(identity, dtype=np.uint8),
+        'pips' : np.array(pips, dtype=np.uint8).reshape(-1, 5),
+        'types' : np.array(types, dtype=np.uint16),
+        'power' : np.array(power, dtype=np.float32),
+        'toughness' : np.array(toughness, dtype=np.float32),
+        'legal' : np.array(legal, dtype=np.uint64),
+        'formats' : np.array(formats, dtype=str)
+    }
+    # Write beside the live file, then swap it in
+    with open('data/columns.npz.tmp', 'wb') as f:
+        np.savez(f, **columns)
+    os.replace('data/columns.npz.tmp', 'data/columns.npz')
+    columns['ids'] = {keys[i] : i for i in range(len(keys))}
+    cardColumns = columns
+    return columns
+# END BUILDCARDCOLUMNS
+
+"""
+pre: file 'data/oracle.json' must exist.
+return: card attribute columns as described in method:buildCardColumns(), along with 'ids', a dictionary mapping normalized names to dense ids.
+post: columns are loaded from 'data/columns.npz' once per process, and rebuilt if missing or out of date with the Oracle.
+"""
+def loadCardColumns() -> dict:
+    global cardColumns
+    import numpy as np
+    stamp = getOracleStamp()
+    if cardColumns != None and cardColumns['oracle'].tolist() == stamp:
+        return cardColumns
+    with indexLock:
+        # Another thread may have loaded them while this one waited
+        if cardColumns != None and cardColumns['oracle'].tolist() == stamp:
+            return cardColumns
+        try:
+            with np.load('data/columns.npz') as f:
+                columns = {name : f[name] for name in f.files}
+            if columns['oracle'].tolist() == stamp:
+                keys = columns['keys'].tolist()
+                columns['ids'] = {keys[i] : i for i in range(len(keys))}
+                cardColumns = columns
+                return columns
+        # Fall through to a rebuild if the columns are missing or unreadable
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        return buildCardColumns()
+# END LOADCARDCOLUMNS
+
+"""
+param: columns, card attribute columns, as returned by method:loadCardColumns().
+param: ids, array of dense card ids.
+param: quantities, array of the quantity of each card in param:ids.
+return: mana curve of the nonland cards (index 7 counts cmc 7 and up), color pips by color, number of cards of each type, and average cmc of the nonland cards.
+"""
+def computeCardStats(columns:dict, ids, quantities) -> dict:
+    import numpy as np
+    types = columns['types'][ids]
+    landBit = 1 << CARD_TYPES.index('Land')
+    nonland = (types & landBit) == 0
+    cmc = columns['cmc'][ids]
+    curve = np.bincount(np.minimum(cmc[nonland], 7).astype(np.int64), weights=quantities[nonland], minlength=8)
+    pips = (columns['pips'][ids].astype(np.int64) * quantities[:, None]).sum(axis=0)
+    typeCounts = {CARD_TYPES[i] : int(quantities[(types & (1 << i)) != 0].sum()) for i in range(len(CARD_TYPES))}
+    nonlandCount = quantities[nonland].sum()
+    averageCmc = float((cmc[nonland] * quantities[nonland]).sum() / nonlandCount) if nonlandCount > 0 else 0.0
+    return {
+        'cards' : int(quantities.sum()),
+        'curve' : [int(n) for n in curve],
+        'pips' : {'WUBRG'[i] : int(pips[i]) for i in range(5)},
+        'types' : typeCounts,
+        'averageCmc' : averageCmc
+    }
+# END COMPUTECARDSTATS
+
+"""
+pre: file corresponding to param:deckName must exist.
+param: deckName, name of deck to analyse.
+return: stats of the deck as described in method:computeCardStats(), or None if file corresponding to param:deckName does not exist. Cards not in the Oracle are left out.
+"""
+def deckStats(deckName:str) -> dict:
+    import numpy as np
+    deck = loadDeck(deckName)
+    if deck == None:
+        return None
+    columns = loadCardColumns()
+    entries = [(columns['ids'][normalizeName(name)], quantity) for name, quantity in deck.items() if normalizeName(name) in columns['ids']]
+    ids = np.array([i for i, _ in entries], dtype=np.int64)
+    quantities = np.array([quantity for _, quantity in entries], dtype=np.int64)
+    return computeCardStats(columns, ids, quantities)
+# END DECKSTATS
+
+"""
+pre: file 'data/oracle.json' must exist.
+return: stats of every card in the Oracle, one copy each, as described in method:computeCardStats().
+"""
+def poolStats() -> dict:
+    import numpy as np
+    columns = loadCardColumns()
+    count = len(columns['keys'])
+    return computeCardStats(columns, np.arange(count), np.ones(count, dtype=np.int64))
+# END POOLSTATS
+
+"""
+param: stats, results of method:computeCardStats().
+post: stats are printed.
+"""
+def printCardStats(stats:dict):
+    print(str(stats['cards']) + ' cards')
+    print('Mana curve:')
+    for cmc in range(len(stats['curve'])):
+        label = str(cmc) + '+' if cmc == len(stats['curve'])-1 else str(cmc)
+        print('  ' + label + ': ' + str(stats['curve'][cmc]))
+    print('Average cmc: ' + format(stats['averageCmc'], '.2f'))
+    print('Color pips: ' + ', '.join([color + ' ' + str(n) for color, n in stats['pips'].items() if n > 0]))
+    print('Types:')
+    for cardType, n in stats['types'].items():
+        if n > 0:
+            print('  ' + cardType + ': ' + str(n))
+# END PRINTCARDSTATS
+
+"""
+param: text, text to split into words.
+return: lowercase words of param:text, as indexed for searching.
+"""
+def tokenize(text:str) -> list:
+    return re.findall(r"[a-z0-9']+", text.lower())
+# END TOKENIZE
+
+"""
+pre: file 'data/oracle.json' must exist.
+post: file 'data/search.pickle' holds, for every card at its dense id in the card attribute columns, its name, lowercase Oracle text and type line, along with inverted indexes mapping each word of the Oracle text and type lines to the sorted ids of the cards using it.
+return: the new search index.
+"""
+def buildSearchIndex() -> dict:
+    global searchIndex
+    ids = loadCardColumns()['ids']
+    names = [''] * len(ids)
+    texts = [''] * len(ids)
+    typeLines = [''] * len(ids)
+    for card in streamOracle():
+        i = ids.get(normalizeName(card['name']))
+        # Keep one entry per name, matching the card attribute columns
+        if i == None or names[i] != '':
+            continue
+        names[i] = card['name']
+        # Search the text of every face of double-faced cards
+        text = card.get('oracle_text', '')
+        for face in card.get('card_faces', []):
+            text += '\n' + face.get('oracle_text', '')
+        texts[i] = text.lower()
+        typeLines[i] = card.get('type_line', '').lower()
+    oracleTokens = {}
+    typeTokens = {}
+    # Ids are visited in order, so every posting list comes out sorted
+    for i in range(len(names)):
+        for token in set(tokenize(texts[i])):
+            oracleTokens.setdefault(token, []).append(i)
+        for token in set(tokenize(typeLines[i])):
+            typeTokens.setdefault(token, []).append(i)
+    index = {'oracle' : getOracleStamp(), 'names' : names, 'texts' : texts, 'typeLines' : typeLines, 'oracleTokens' : oracleTokens, 'typeTokens' : typeTokens}
+    with open('data/search.pickle.tmp', 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace('data/search.pickle.tmp', 'data/search.pickle')
+    searchIndex = index
+    return index
+# END BUILDSEARCHINDEX
 
 """
-pre: file 'data/decks/_details.txt' must exist and have all but its first character representing the name of the deck last referenced by the user, or the default if no deck has been referenced.
-param: deckName, name of deck to be referenced in the future.
-post: updates the string stored in in file 'data/decks/_details.txt' representing the name of the deck last referenced by the user to be param:deckName.
-"""   
-def updateRecentDeck(deckName:str):
-    with open('data/decks/_details.txt', 'r') as f:
-        # Read details
-        details = f.read()
-    with open('data/decks/_details.txt', 'w') as f:
-        # Write back first digit of details
-        f.write(details[0])
-    with open('data/decks/_details.txt', 'a') as f:
-        # Write back updated deck name as new remaining digits of details
-        f.write(deckName)
-# END UPDATERECENTDECK
+pre: file 'data/oracle.json' must exist.
+return: search index as described in method:buildSearchIndex().
+post: index is loaded from 'data/search.pickle' once per process, and rebuilt if missing or out of date with the Oracle.
+"""
+def loadSearchIndex() -> dict:
+    global searchIndex
+    stamp = getOracleStamp()
+    if searchIndex != None and searchIndex['oracle'] == stamp:
+        return searchIndex
+    with indexLock:
+        # Another thread may have loaded it while this one waited
+        if searchIndex != None and searchIndex['oracle'] == stamp:
+            return searchIndex
+        try:
+            with open('data/search.pickle', 'rb') as f:
+                index = pickle.load(f)
+            if index['oracle'] == stamp:
+                searchIndex = index
+                return index
+        # Fall through to a rebuild if the index is missing or unreadable
+        except (FileNotFoundError, pickle.UnpicklingError, EOFError, KeyError):
+            pass
+        return buildSearchIndex()
+# END LOADSEARCHINDEX
 
 """
-pre: file corresponding to param:deckName must exist and have some data in it. If creating a new deck without the use of method:createDeck(), this data can just be '[]'.
-param: deckName, name of deck to goldfish with.
-post: list seven random cards from the deck of name param:deckName
-return: -1 if file corresponding to param:deckName does not exist. 
-"""   
-def goldfish(deckName:str) -> int:
-    # Store path to deck file
-    deckPath = 'data/decks/' + deckName + '.json'
+param: tokens, inverted index mapping words to sorted card ids.
+param: texts, text of every card, by card id.
+param: value, word or phrase to search for.
+param: count, number of cards.
+return: NumPy boolean mask over every card id, set for the cards whose text contains param:value.
+"""
+def matchText(tokens:dict, texts:list, value:str, count:int):
+    import numpy as np
+    mask = np.zeros(count, dtype=bool)
+    words = tokenize(value)
+    if len(words) == 0:
+        return mask
+    # Narrow down to the cards using every word, starting from the rarest
+    postings = sorted([tokens.get(word, []) for word in words], key=len)
+    candidates = set(postings[0]).intersection(*postings[1:])
+    # Then check the exact phrase only on those cards
+    phrase = value.lower()
+    matches = [i for i in candidates if len(words) == 1 or phrase in texts[i]]
+    mask[matches] = True
+    return mask
+# END MATCHTEXT
+
+"""
+param: values, NumPy array of values to compare.
+param: op, comparison operator, one of ':', '=', '!=', '<', '<=', '>', '>='.
+param: target, value to compare param:values to.
+return: NumPy boolean mask of the values for which the comparison holds.
+"""
+def compareValues(values, op:str, target:float):
+    if op == ':' or op == '=':
+        return values == target
+    if op == '!=':
+        return values != target
+    if op == '<':
+        return values < target
+    if op == '<=':
+        return values <= target
+    if op == '>':
+        return values > target
+    return values >= target
+# END COMPAREVALUES
+
+"""
+pre: file 'data/oracle.json' must exist.
+param: query, search in Scryfall-style syntax. Terms are separated by spaces and must all match. Values with spaces are double-quoted, and a term is negated by a leading '-'. Supported terms are 't:' type, 'o:' Oracle text, 'c' colors and 'id' color identity (with ':' or '>=' for at least, '=' for exactly and '<=' for at most these colors, 'c' meaning colorless), 'cmc', 'pow' and 'tou' compared with any of ':', '=', '!=', '<', '<=', '>', '>=', 'f:' format legality, and bare words matched against card names.
+param: limit, maximum number of names to return, or None for no limit.
+return: alphabetical list of the names of matching cards, or None if param:query cannot be parsed.
+"""
+def searchCards(query:str, limit:int=None) -> list:
+    import numpy as np
+    columns = loadCardColumns()
+    index = loadSearchIndex()
+    count = len(index['names'])
+    # Quote with double quotes only, so apostrophes in names such as Urza's stay part of their word
+    lexer = shlex.shlex(query, posix=True)
+    lexer.quotes = '"'
+    lexer.whitespace_split = True
+    lexer.commenters = ''
     try:
-        with open(deckPath, encoding='utf8') as f:
-            # Read deck (as list of dictionaries)
-            deck = json.load(f)
-            # Initialize list of unique random indices of the deck
-            uniqueRandIndices = []
-            # Store deck size
-            numCards = len(deck)
-            # Initialize starting hand size
-            handSize = 7
-            # Reduce starting hand size if deck is too small
-            if handSize > numCards:
-                handSize = numCards
-            # Generate a number of random indices of the deck equal to the hand size
-            for _ in range(0,handSize):
-                # Initialize random index
-                randIndex = -1
-                # Generate a random index of the deck until one that has not been stored already is generated
-                while randIndex in uniqueRandIndices or randIndex == -1:
-                    randIndex = rng.randint(0,numCards-1)
-                # Store random index
-                uniqueRandIndices.append(randIndex)
-            # Initialize hand
-            hand = []
-            # Load cards into hand using list of random indices of the deck
-            for i in uniqueRandIndices:
-                hand.append(deck[i]['name'])
-            # Print cards in hand    
-            print(hand)
-    # Return error code if requested deck DNE
-    except FileNotFoundError:
-        return -1
-    # Normal return
-    return 0
-# END GOLDFISH
+        terms = list(lexer)
+    # Unbalanced quotes
+    except ValueError:
+        return None
+    mask = np.ones(count, dtype=bool)
+    for term in terms:
+        match = re.fullmatch(r'(-?)([a-z]+)(:|=|!=|<=|>=|<|>)(.+)', term, re.IGNORECASE)
+        if match == None:
+            # Bare words, including negated ones, are matched against card names
+            negate = term.startswith('-') and len(term) > 1
+            word = normalizeName(term[1:] if negate else term)
+            termMask = np.char.find(columns['keys'], word) != -1
+        else:
+            negate = match.group(1) == '-'
+            key = match.group(2).lower()
+            op = match.group(3)
+            value = match.group(4)
+            if key in ('t', 'type') and op == ':':
+                termMask = matchText(index['typeTokens'], index['typeLines'], value, count)
+            elif key in ('o', 'oracle') and op == ':':
+                termMask = matchText(index['oracleTokens'], index['texts'], value, count)
+            elif key in ('c', 'color', 'id', 'identity'):
+                # Colorless cannot be mixed with colors
+                if re.fullmatch('[wubrg]+|c', value, re.IGNORECASE) == None:
+                    return None
+                target = getColorMask(value.upper())
+                values = columns['colors'] if key in ('c', 'color') else columns['identity']
+                # Compare colors as sets, using their bitmasks. Colorless has an empty mask, which every card would contain, so it matches only colorless cards
+                if target == 0 and op in (':', '>=', '<='):
+                    termMask = values == 0
+                elif op == ':' or op == '>=':
+                    termMask = (values & target) == target
+                elif op == '=':
+                    termMask = values == target
+                elif op == '<=':
+                    termMask = (values & ~np.uint8(target)) == 0
+                elif op == '>':
+                    termMask = ((values & target) == target) & (values != target)
+                elif op == '<':
+                    termMask = ((values & ~np.uint8(target)) == 0) & (values != target)
+                else:
+                    termMask = values != target
+            elif key in ('cmc', 'mv', 'pow', 'power', 'tou', 'toughness'):
+                try:
+                    target = float(value)
+                except ValueError:
+                    return None
+                column = {'cmc' : 'cmc', 'mv' : 'cmc', 'pow' : 'power', 'power' : 'power', 'tou' : 'toughness', 'toughness' : 'toughness'}[key]
+                termMask = compareValues(columns[column], op, target)
+            elif key in ('f', 'format', 'legal') and op == ':':
+                formats = columns['formats'].tolist()
+                if value.lower() not in formats:
+                    return None
+                termMask = (columns['legal'] & np.uint64(1 << formats.index(value.lower()))) != 0
+            else:
+                return None
+        if negate:
+            termMask = ~termMask
+        mask &= termMask
+    names = sorted([index['names'][i] for i in np.flatnonzero(mask)])
+    if limit != None:
+        names = names[0:limit]
+    return names
+# END SEARCHCARDS
 
 """
 param: request, a string containing a card name and optionally a quantity of that card. If included, the quantity should follow the card name and be preceded by a space.
@@ -477,42 +2732,727 @@ def parseCardRequest(request:str) -> (str, int):
 # END PARSECARDREQUEST
 
 """
-pre: User must have an unbroken internet connection during pull
-post: Data in file data/oracle.json is updated from Scryfall.
+return: details of the last pull stored in file 'data/pull.json', or an empty dictionary if there is none.
+"""
+def loadPullDetails() -> dict:
+    try:
+        with open('data/pull.json', encoding='utf8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+# END LOADPULLDETAILS
+
+"""
+param: details, details of the current pull.
+post: file 'data/pull.json' is atomically replaced with param:details.
+"""
+def savePullDetails(details:dict):
+    with open('data/pull.json.tmp', 'w', encoding='utf8') as f:
+        json.dump(details, f)
+    os.replace('data/pull.json.tmp', 'data/pull.json')
+# END SAVEPULLDETAILS
+
+"""
+param: apiURL, base url of the Scryfall API, which can be pointed at a local server.
+return: -1 if a bad response was received or the download was cut off, otherwise 0.
+post: Data in file data/oracle.json is updated from Scryfall, unless Scryfall reports no change since the last pull. The download is streamed to 'data/oracle.json.part', resumed from there if an earlier pull of the same data was cut off, and swapped in atomically once complete.
 """   
-def pullData():
+def pullData(apiURL:str='https://api.scryfall.com') -> int:
+    import requests
+    session = getHTTPSession()
     # Request main data interface from Scryfall API
-    response = requests.get('https://api.scryfall.com/bulk-data')
-    if response.ok:
-        # Store main data interface string
-        bulkDataStr = response.text
-        # Convert main data interface string to JSON
-        bulkDataJSON = json.loads(bulkDataStr)
-        # Extract Oracle download URI from main data interface
-        oracleURI = bulkDataJSON['data'][0]['download_uri']
-        # Request Oracle data from URI
-        response = requests.get(oracleURI)
-        if response.ok:
-            # Store Oracle data string
-            oracleData = response.text
-            with open('data/oracle.json', 'w', encoding='utf8') as f:
-                # Write to Oracle file
-                f.write(oracleData)
-            # Report success and return
-            print('Pull successful')
-            return
-    # Report failure if a bad response was received from either request
-    print('Pull failed')
-# END PARSECARDREQUEST
+    try:
+        response = session.get(apiURL + '/bulk-data', timeout=30)
+    except requests.RequestException:
+        response = None
+    if response == None or not response.ok:
+        # Report failure if a bad response was received
+        print('Pull failed')
+        return -1
+    # Find the Oracle entry of the main data interface, falling back on the first entry
+    bulkData = response.json()['data']
+    entry = bulkData[0]
+    for item in bulkData:
+        if item.get('type') == 'oracle_cards':
+            entry = item
+    # Skip the download entirely if Scryfall has not published new data since the last pull
+    details = loadPullDetails()
+    current = details.get('current', {})
+    if os.path.isfile('data/oracle.json') and current.get('updated_at') == entry.get('updated_at') and current.get('size') == entry.get('size'):
+        print('Oracle data is already up to date')
+        return 0
+    oracleURI = entry['download_uri']
+    partPath = 'data/oracle.json.part'
+    # Compressed files cannot be resumed, as their offsets do not match the decompressed part file
+    gzipped = oracleURI.endswith('.gz')
+    headers = {}
+    offset = 0
+    partial = details.get('partial', {})
+    # A part file written through the decompressor cannot be resumed either, however the server flagged it as gzip
+    if not gzipped and partial.get('decompressed') == False and os.path.isfile(partPath) and os.path.getsize(partPath) > 0 and partial.get('updated_at') == entry.get('updated_at'):
+        # Resume a cut-off download of the same data, asking for the rest of the file uncompressed
+        offset = os.path.getsize(partPath)
+        headers['Range'] = 'bytes=' + str(offset) + '-'
+        headers['Accept-Encoding'] = 'identity'
+        if partial.get('etag') != None:
+            headers['If-Range'] = partial['etag']
+    elif os.path.isfile('data/oracle.json') and current.get('etag') != None:
+        # Let the server confirm the Oracle file has not changed even if its details have
+        headers['If-None-Match'] = current['etag']
+    try:
+        # Request Oracle data from URI, streaming rather than holding it all in memory
+        with session.get(oracleURI, headers=headers, stream=True, timeout=60) as response:
+            if response.status_code == 304:
+                details['current'] = {'updated_at' : entry.get('updated_at'), 'size' : entry.get('size'), 'etag' : current.get('etag')}
+                savePullDetails(details)
+                print('Oracle data is already up to date')
+                return 0
+            if not response.ok:
+                print('Pull failed')
+                return -1
+            # Start over if the server sent the whole file instead of the requested range
+            if response.status_code != 206:
+                offset = 0
+            etag = response.headers.get('ETag', partial.get('etag'))
+            # Decompress gzip files on the fly. Compressed transfer encoding is already undone by method:iter_content()
+            decompressor = None
+            if gzipped or response.headers.get('Content-Type', '').startswith('application/gzip'):
+                # The rest of a compressed file cannot be decompressed on its own, so drop the part file for the next pull to start over
+                if offset > 0:
+                    details.pop('partial', None)
+                    savePullDetails(details)
+                    os.remove(partPath)
+                    print('Pull failed')
+                    return -1
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            # Record whether the part file is decompressed, which decides whether it can be resumed
+            details['partial'] = {'updated_at' : entry.get('updated_at'), 'etag' : etag, 'decompressed' : decompressor != None}
+            savePullDetails(details)
+            with open(partPath, 'ab' if offset > 0 else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1024*1024):
+                    if decompressor != None:
+                        chunk = decompressor.decompress(chunk)
+                    f.write(chunk)
+                if decompressor != None:
+                    f.write(decompressor.flush())
+                f.flush()
+                os.fsync(f.fileno())
+    # Keep the part file to resume from if the download was cut off
+    except requests.RequestException:
+        print('Pull failed')
+        return -1
+    # Release the map of the old Oracle before swapping in the new one
+    closeOracleMap()
+    os.replace(partPath, 'data/oracle.json')
+    details['current'] = {'updated_at' : entry.get('updated_at'), 'size' : entry.get('size'), 'etag' : etag}
+    details.pop('partial', None)
+    savePullDetails(details)
+    # Rebuild name index, card store and card columns against the new Oracle data, holding off read requests to the card service that would rebuild them too
+    with indexLock:
+        buildIndex()
+        buildCardStore()
+        # Card columns and the search index need NumPy, and are otherwise built on first use
+        try:
+            buildCardColumns()
+            buildSearchIndex()
+        except ImportError:
+            pass
+    # Report success and return
+    print('Pull successful')
+    return 0
+# END PULLDATA
+
+"""
+param: line, one line of a batch script.
+return: the action of param:line and its arguments, as a list of words, or None if param:line is blank or a comment. A ValueError is raised if param:line has an unbalanced double quote.
+"""
+def parseBatchCommand(line:str) -> (str, list):
+    # Quote with double quotes only, so apostrophes in names such as Urza's Saga stay part of their word
+    lexer = shlex.shlex(line, posix=True)
+    lexer.quotes = '"'
+    lexer.whitespace_split = True
+    lexer.commenters = '#'
+    words = list(lexer)
+    if len(words) == 0:
+        return None
+    return words[0].lower(), words[1:]
+# END PARSEBATCHCOMMAND
+
+"""
+param: lines, lines of a batch script. Each line holds one command: 'add <card> [quantity] -> <deck> [filters]' (with card 'random' to draw random cards, optionally filtered as in method:parseSampleFilters()), 'remove <card> [quantity] -> <deck>', 'replace <card> [quantity] with <card> [quantity] -> <deck>', 'new <deck>', 'delete <deck>' or 'export <deck> -> <file> [format]'. Names with spaces may be double-quoted, and '#' starts a comment.
+param: out, stream to report results to.
+post: every deck the batch names is locked for its whole run, every command is run against decks held in memory, and each changed deck is written once at the end, through the write-ahead log (see method:writeDecks()). A JSON object is written to param:out for each command, holding its line number, whether it succeeded, and an error and failing card names if not.
+return: exit code: 0 if every command succeeded, 1 if any failed.
+"""
+def runBatch(lines, out=sys.stdout) -> int:
+    # Parse every command up front, so the decks the batch touches can all be locked before it starts
+    commands = []
+    deckNames = set()
+    lineNumber = 0
+    for line in lines:
+        lineNumber += 1
+        try:
+            command = parseBatchCommand(line)
+        except ValueError as e:
+            # Report the line as it failed to parse, rather than as an unknown command
+            commands.append((lineNumber, line.strip(), 'invalid', [], None, [], 'Line could not be parsed: ' + str(e)))
+            continue
+        if command == None:
+            continue
+        action, words = command
+        # Split off the target after '->'
+        target = None
+        filters = []
+        if '->' in words:
+            arrow = words.index('->')
+            if arrow+1 < len(words):
+                target = words[arrow+1]
+                filters = words[arrow+2:]
+            words = words[0:arrow]
+        commands.append((lineNumber, line.strip(), action, words, target, filters, None))
+        if action in ('add', 'remove', 'replace') and target != None:
+            deckNames.add(target)
+        elif action in ('new', 'delete', 'export') and len(words) == 1:
+            deckNames.add(words[0])
+    # Decks loaded so far, and which of them have been changed, created or deleted
+    decks = {}
+    dirty = set()
+    deleted = set()
+    """
+    param: deckName, name of deck to fetch.
+    return: deck in its current state within the batch, or None if it does not exist.
+    """
+    def getDeck(deckName:str) -> dict:
+        if deckName in deleted:
+            return None
+        if deckName not in decks:
+            decks[deckName] = loadDeck(deckName)
+        return decks[deckName]
+    failed = False
+    with contextlib.ExitStack() as stack:
+        # Take the deck locks in name order, so batches touching overlapping decks cannot deadlock
+        for deckName in sorted(deckNames):
+            stack.enter_context(lockFile('deck-' + deckName))
+        for lineNumber, line, action, words, target, filters, parseError in commands:
+            startCommand('batch ' + action)
+            result = {'line' : lineNumber, 'command' : line, 'ok' : True}
+            error = None
+            if parseError != None:
+                error = parseError
+            elif action in ('add', 'remove', 'replace'):
+                deck = getDeck(target) if target != None else None
+                if target == None:
+                    error = 'No deck given'
+                elif deck == None:
+                    error = 'Deck does not exist'
+                else:
+                    changes = []
+                    if action == 'replace':
+                        if 'with' not in words:
+                            words = []
+                        else:
+                            split = words.index('with')
+                            removeName, removeQuantity = parseCardRequest(' '.join(words[0:split]))
+                            changes.append(('remove', removeName, removeQuantity))
+                            words = words[split+1:]
+                    cardName, cardQuantity = parseCardRequest(' '.join(words))
+                    if cardName == '':
+                        error = 'No card given'
+                    elif action == 'remove':
+                        changes.append(('remove', cardName, cardQuantity))
+                    elif cardName.lower() == 'random':
+                        sampleFilters = parseSampleFilters(' '.join(filters))
+                        if sampleFilters == None:
+                            error = 'Filters not recognized'
+                        else:
+                            changes += [('add', card['name'], 1) for card in sampleCards(cardQuantity, **sampleFilters)]
+                    else:
+                        changes.append(('add', cardName, cardQuantity))
+                    if error == None:
+                        # Stage against a copy so a failing command leaves the deck as it was
+                        staged = dict(deck)
+                        failures = stageDeckChanges(staged, changes)
+                        if len(failures) > 0:
+                            error = 'Cards not found'
+                            result['failures'] = failures
+                        else:
+                            decks[target] = staged
+                            dirty.add(target)
+            elif action in ('new', 'delete') and len(words) == 1:
+                deckName = words[0]
+                if action == 'new':
+                    if getDeck(deckName) != None:
+                        error = 'Deck already exists'
+                    else:
+                        decks[deckName] = {}
+                        deleted.discard(deckName)
+                        dirty.add(deckName)
+                else:
+                    if getDeck(deckName) == None:
+                        error = 'Deck does not exist'
+                    else:
+                        deleted.add(deckName)
+                        dirty.discard(deckName)
+                        decks.pop(deckName)
+            elif action == 'export' and len(words) == 1 and target != None:
+                fmt = filters[0].lower() if len(filters) > 0 else 'default'
+                deck = getDeck(words[0])
+                if deck == None:
+                    error = 'Deck does not exist'
+                elif fmt not in EXPORT_FORMATS:
+                    error = 'Format not recognized'
+                else:
+                    try:
+                        with open(target, 'w', encoding='utf8', newline='') as dest:
+                            for exportLine in iterDeckLines(deck, fmt):
+                                dest.write(exportLine)
+                    except OSError:
+                        error = 'File could not be written'
+            else:
+                error = 'Command not recognized'
+            if error != None:
+                result['ok'] = False
+                result['error'] = error
+                failed = True
+            finishCommand()
+            out.write(json.dumps(result) + '\n')
+        # Flush every changed deck once, now that all commands have run, through the write-ahead log so that either all or none of them are written
+        changed = dict([(deckName, decks[deckName]) for deckName in dirty])
+        for deckName in deleted:
+            changed[deckName] = None
+        if len(changed) > 0:
+            writeDecks(changed)
+    if failed:
+        return 1
+    # Normal return
+    return 0
+# END RUNBATCH
+
+"""
+return: empty latency histogram, counting observations per bucket of var:LATENCY_BUCKETS.
+"""
+def makeHistogram() -> dict:
+    return {'buckets' : [0] * (len(LATENCY_BUCKETS)+1), 'count' : 0, 'sum' : 0.0, 'max' : 0.0}
+# END MAKEHISTOGRAM
+
+"""
+param: kind, group of histograms to record in: 'commands', 'functions' or 'http'.
+param: name, name of the command, function or host observed.
+param: seconds, latency observed.
+post: latency is recorded in the histogram of param:name.
+"""
+def observeLatency(kind:str, name:str, seconds:float):
+    with metricsLock:
+        histogram = metrics[kind].get(name)
+        if histogram == None:
+            histogram = metrics[kind][name] = makeHistogram()
+        histogram['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        histogram['max'] = max(histogram['max'], seconds)
+# END OBSERVELATENCY
+
+"""
+param: event, name of the event, such as 'cache_hit'.
+post: count of param:event is increased by one.
+"""
+def countEvent(event:str):
+    with metricsLock:
+        metrics['events'][event] = metrics['events'].get(event, 0) + 1
+# END COUNTEVENT
+
+"""
+param: target, file or folder the bytes went to or came from. Files in the deck, image and thumbnail folders are counted under their folder.
+param: direction, 'read' or 'write'.
+param: count, number of bytes, or of characters for files opened as text.
+post: count is added to the I/O total of param:target in param:direction.
+"""
+def countBytes(target:str, direction:str, count:int):
+    if target.startswith('data/decks/') or target.startswith('data/images/') or target.startswith('data/thumbs/'):
+        target = os.path.dirname(target)
+    elif target.endswith('.tmp'):
+        target = target[0:-4]
+    key = target + ' ' + direction
+    with metricsLock:
+        metrics['io'][key] = metrics['io'].get(key, 0) + count
+# END COUNTBYTES
+
+"""
+param: name, name of the function.
+param: function, function to time.
+return: stand-in for param:function that records the latency of each call.
+"""
+def instrumentFunction(name:str, function):
+    def instrumented(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            observeLatency('functions', name, time.perf_counter() - start)
+    return instrumented
+# END INSTRUMENTFUNCTION
+
+"""
+return: stand-in for the built-in open() which counts the bytes read from and written to each file it opens.
+"""
+def makeCountingOpen():
+    builtinOpen = open
+    # Passes everything through to the real file, counting the data that goes by
+    class CountingFile:
+        def __init__(self, f, fileName:str):
+            self.f = f
+            self.fileName = fileName
+        def __getattr__(self, attr):
+            return getattr(self.f, attr)
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
+            return self.f.__exit__(*exc)
+        def __iter__(self):
+            for line in self.f:
+                countBytes(self.fileName, 'read', len(line))
+                yield line
+        def read(self, *args):
+            data = self.f.read(*args)
+            countBytes(self.fileName, 'read', len(data))
+            return data
+        def readinto(self, buffer):
+            count = self.f.readinto(buffer)
+            countBytes(self.fileName, 'read', count or 0)
+            return count
+        def readline(self, *args):
+            data = self.f.readline(*args)
+            countBytes(self.fileName, 'read', len(data))
+            return data
+        def write(self, data):
+            countBytes(self.fileName, 'write', len(data))
+            return self.f.write(data)
+    def countingOpen(file, *args, **kwargs):
+        f = builtinOpen(file, *args, **kwargs)
+        # Leave descriptors and other non-path files alone
+        if not isinstance(file, str):
+            return f
+        return CountingFile(f, file)
+    return countingOpen
+# END MAKECOUNTINGOPEN
+
+"""
+param: response, response to a request made through an HTTP session of this module.
+post: time until the response headers arrived is recorded for the host, along with the announced size of the body.
+"""
+def recordHTTPResponse(response, *args, **kwargs):
+    host = response.url.split('/')[2] if response.url.count('/') >= 2 else response.url
+    observeLatency('http', host, response.elapsed.total_seconds())
+    countBytes('http://' + host, 'read', int(response.headers.get('Content-Length', 0) or 0))
+# END RECORDHTTPRESPONSE
+
+"""
+post: every function in var:INSTRUMENTED_FUNCTIONS is replaced in this module by a stand-in recording its latency, and file reads and writes, HTTP responses, cache hits and misses and REPL commands are counted from here on. Nothing is recorded unless this is called, so there is no cost otherwise.
+"""
+def enableInstrumentation():
+    global metrics
+    if metrics != None:
+        return
+    metrics = {'commands' : {}, 'functions' : {}, 'http' : {}, 'events' : {}, 'io' : {}}
+    for name in INSTRUMENTED_FUNCTIONS:
+        globals()[name] = instrumentFunction(name, globals()[name])
+    globals()['open'] = makeCountingOpen()
+# END ENABLEINSTRUMENTATION
+
+"""
+param: command, name of the command starting.
+post: the command is timed, and profiled if var:profileFolder is set, until method:finishCommand() is called.
+"""
+def startCommand(command:str):
+    global runningCommand
+    if metrics == None and profileFolder == None:
+        return
+    profiler = None
+    if profileFolder != None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    runningCommand = (command, time.perf_counter(), profiler)
+# END STARTCOMMAND
+
+"""
+param: command, new name of the command started by method:startCommand().
+post: the running command keeps its start time and profiler, but is recorded under param:command when finished.
+"""
+def renameCommand(command:str):
+    global runningCommand
+    if runningCommand != None:
+        runningCommand = (command,) + runningCommand[1:]
+# END RENAMECOMMAND
+
+"""
+post: the latency of the command started by method:startCommand() is recorded, and its profile written to a file in var:profileFolder named after the process id and a count of the commands it has profiled, readable with the pstats module.
+"""
+def finishCommand():
+    global runningCommand, profileCount
+    if runningCommand == None:
+        return
+    command, start, profiler = runningCommand
+    runningCommand = None
+    if profiler != None:
+        profiler.disable()
+        profileCount += 1
+        # Prefix with the process id, so a later run into the same folder does not overwrite earlier captures
+        profiler.dump_stats(os.path.join(profileFolder, str(os.getpid()) + '-' + str(profileCount) + '-' + command.replace(' ', '-').replace('/', '-') + '.prof'))
+    if metrics != None:
+        observeLatency('commands', command, time.perf_counter() - start)
+# END FINISHCOMMAND
+
+"""
+param: histogram, latency histogram as built by method:makeHistogram().
+param: q, quantile between 0 and 1.
+return: upper bound of the bucket holding quantile param:q, or the slowest observation for the last bucket.
+"""
+def getQuantile(histogram:dict, q:float) -> float:
+    seen = 0
+    for i in range(len(LATENCY_BUCKETS)):
+        seen += histogram['buckets'][i]
+        if seen >= q * histogram['count']:
+            return min(LATENCY_BUCKETS[i], histogram['max'])
+    return histogram['max']
+# END GETQUANTILE
+
+"""
+return: snapshot of the metrics collected so far, with image cache hits and misses included among the events.
+"""
+def getStats() -> dict:
+    with metricsLock:
+        stats = json.loads(json.dumps(metrics))
+    stats['events']['image_cache_hit'] = imageCacheStats['hits']
+    stats['events']['image_cache_miss'] = imageCacheStats['misses']
+    stats['buckets'] = LATENCY_BUCKETS
+    return stats
+# END GETSTATS
+
+"""
+pre: instrumentation must be enabled (see method:enableInstrumentation()).
+post: latencies of commands, functions and HTTP requests, cache hit ratios and I/O totals collected so far are displayed.
+"""
+def printStats():
+    stats = getStats()
+    for kind, title in [('commands', 'Commands'), ('functions', 'Functions'), ('http', 'HTTP requests')]:
+        if len(stats[kind]) == 0:
+            continue
+        print(title + ':')
+        # Show whatever took the most time overall first
+        for name, histogram in sorted(stats[kind].items(), key=lambda item: -item[1]['sum']):
+            print('  %-24s %7d calls  total %10.1f ms  mean %8.2f ms  p50 <= %8.2f ms  p95 <= %8.2f ms  max %8.2f ms' % (name, histogram['count'], histogram['sum']*1000, histogram['sum']*1000/histogram['count'], getQuantile(histogram, 0.5)*1000, getQuantile(histogram, 0.95)*1000, histogram['max']*1000))
+    events = stats['events']
+    for cache, title in [('cache', 'Card cache'), ('image_cache', 'Image cache')]:
+        hits = events.get(cache + '_hit', 0)
+        misses = events.get(cache + '_miss', 0)
+        if hits + misses > 0:
+            print(title + ': ' + str(hits) + ' hits, ' + str(misses) + ' misses (' + str(round(100 * hits / (hits + misses), 1)) + '% hit rate)')
+    if len(stats['io']) > 0:
+        print('I/O:')
+        for key, count in sorted(stats['io'].items()):
+            print('  %-36s %12d bytes' % (key, count))
+# END PRINTSTATS
+
+"""
+return: iterator over the lines of the metrics collected so far in the Prometheus text format.
+"""
+def iterPrometheusLines():
+    stats = getStats()
+    for kind, label in [('commands', 'command'), ('functions', 'function'), ('http', 'host')]:
+        metric = 'deckbuilder_' + kind + '_seconds'
+        yield '# TYPE ' + metric + ' histogram\n'
+        for name, histogram in sorted(stats[kind].items()):
+            labels = label + '="' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+            # Prometheus buckets are cumulative
+            seen = 0
+            for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], histogram['buckets']):
+                seen += count
+                yield metric + '_bucket{' + labels + ',le="' + str(bound) + '"} ' + str(seen) + '\n'
+            yield metric + '_sum{' + labels + '} ' + repr(histogram['sum']) + '\n'
+            yield metric + '_count{' + labels + '} ' + str(histogram['count']) + '\n'
+    yield '# TYPE deckbuilder_events_total counter\n'
+    for event, count in sorted(stats['events'].items()):
+        yield 'deckbuilder_events_total{event="' + event + '"} ' + str(count) + '\n'
+    yield '# TYPE deckbuilder_io_bytes_total counter\n'
+    for key, count in sorted(stats['io'].items()):
+        target, direction = key.rsplit(' ', 1)
+        yield 'deckbuilder_io_bytes_total{target="' + target + '",direction="' + direction + '"} ' + str(count) + '\n'
+# END ITERPROMETHEUSLINES
+
+"""
+pre: instrumentation must be enabled (see method:enableInstrumentation()).
+param: fileName, name of file to write to.
+param: fmt, 'json' or 'prometheus'.
+post: metrics collected so far are written to file param:fileName in format param:fmt.
+return: -1 if param:fmt is not recognized.
+"""
+def exportStats(fileName:str, fmt:str) -> int:
+    if fmt not in ('json', 'prometheus'):
+        return -1
+    with open(fileName, 'w', encoding='utf8') as f:
+        if fmt == 'json':
+            json.dump(getStats(), f, indent=1)
+        else:
+            for line in iterPrometheusLines():
+                f.write(line)
+    # Normal return
+    return 0
+# END EXPORTSTATS
+
+"""
+post: the indexes used by the card service are loaded into memory ahead of the first request.
+"""
+def warmCardService():
+    if os.path.isfile('data/oracle.json'):
+        loadIndex()
+        loadNameSearch()
+        openCardStore()
+        # Columns and the search index need NumPy, and are otherwise loaded on first use
+        try:
+            loadCardColumns()
+            loadSearchIndex()
+        except ImportError:
+            pass
+    loadCache()
+# END WARMCARDSERVICE
+
+"""
+param: request, JSON request holding the name of a function in var:SERVICE_OPS as 'op', and its 'args' and 'kwargs'.
+return: JSON response holding the function's return value as 'result', or the error raised by it as 'error'.
+"""
+def handleServiceRequest(request:dict) -> dict:
+    op = request.get('op')
+    if op not in SERVICE_OPS:
+        return {'ok' : False, 'error' : 'Unknown operation ' + str(op)}
+    function = globals()[op]
+    try:
+        # Reads of prebuilt indexes run side by side, anything that could write waits its turn
+        if op in SERVICE_READ_OPS:
+            result = function(*request.get('args', []), **request.get('kwargs', {}))
+        else:
+            with serviceLock:
+                result = function(*request.get('args', []), **request.get('kwargs', {}))
+    except Exception as e:
+        return {'ok' : False, 'error' : type(e).__name__ + ': ' + str(e)}
+    return {'ok' : True, 'result' : result}
+# END HANDLESERVICEREQUEST
+
+"""
+param: socketPath, path of the Unix socket to serve on.
+post: card service runs until interrupted, answering lookup, deck mutation and query requests from any number of clients, one line of JSON per request and response.
+"""
+def runDaemon(socketPath:str='data/daemon.sock'):
+    # Handle each client connection on its own thread, for as many requests as it sends
+    class ServiceHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    response = handleServiceRequest(json.loads(line))
+                except ValueError:
+                    response = {'ok' : False, 'error' : 'Request is not valid JSON'}
+                self.wfile.write(json.dumps(response, default=encodeCard).encode('utf8') + b'\n')
+                self.wfile.flush()
+    warmCardService()
+    # Clear a socket left behind by a daemon that did not shut down cleanly
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    server = socketserver.ThreadingUnixStreamServer(socketPath, ServiceHandler)
+    server.daemon_threads = True
+    print('Card service listening on ' + socketPath)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socketPath)
+# END RUNDAEMON
+
+"""
+param: op, name of a function in var:SERVICE_OPS.
+return: stand-in for the function that runs it in the card service over the connection opened by method:connectDaemon().
+"""
+def makeRemoteOp(op:str):
+    def remoteOp(*args, **kwargs):
+        request = json.dumps({'op' : op, 'args' : args, 'kwargs' : kwargs}).encode('utf8') + b'\n'
+        # Keep each request and its response together when several threads share the connection
+        with daemonConnection['lock']:
+            daemonConnection['file'].write(request)
+            daemonConnection['file'].flush()
+            line = daemonConnection['file'].readline()
+        if line == b'':
+            raise ConnectionError('Card service closed the connection')
+        response = json.loads(line)
+        if not response['ok']:
+            raise RuntimeError(response['error'])
+        return response['result']
+    return remoteOp
+# END MAKEREMOTEOP
+
+"""
+param: socketPath, path of the Unix socket the card service is listening on.
+post: every function in var:SERVICE_OPS is replaced in this module by a stand-in that runs it in the card service, so the rest of the module, the REPL and importing scripts all use the service's in-memory state.
+return: -1 if the card service could not be reached.
+"""
+def connectDaemon(socketPath:str='data/daemon.sock') -> int:
+    global daemonConnection
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socketPath)
+    except (OSError, AttributeError):
+        return -1
+    daemonConnection = {'socket' : sock, 'file' : sock.makefile('rwb'), 'lock' : threading.Lock()}
+    for op in SERVICE_OPS:
+        globals()[op] = makeRemoteOp(op)
+    # Normal return
+    return 0
+# END CONNECTDAEMON
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Command line deck builder for Magic: The Gathering.')
+    parser.add_argument('--daemon', action='store_true', help='run the card service, keeping indexes loaded for REPLs and scripts to connect to')
+    parser.add_argument('--connect', action='store_true', help='run the REPL as a client of a running card service')
+    parser.add_argument('--batch', metavar='FILE', help="run the commands in FILE ('-' for standard input) without prompting, and report a JSON result for each")
+    parser.add_argument('--instrument', action='store_true', help='record command and function latencies, cache hits and misses, and file and HTTP I/O, shown by the "stats" command')
+    parser.add_argument('--profile', metavar='FOLDER', help='write a cProfile capture of every command to FOLDER')
+    parser.add_argument('--socket', default='data/daemon.sock', help='Unix socket of the card service (default: data/daemon.sock)')
+    args = parser.parse_args()
+    if args.profile != None:
+        os.makedirs(args.profile, exist_ok=True)
+        profileFolder = args.profile
+    if args.daemon:
+        if args.instrument:
+            enableInstrumentation()
+        recoverDecks()
+        migrateDecks()
+        runDaemon(args.socket)
+        sys.exit(0)
+    if args.connect:
+        if connectDaemon(args.socket) == -1:
+            print('Could not reach card service, running locally')
+    # Instrument after connecting, so calls to the card service are timed from this end
+    if args.instrument:
+        enableInstrumentation()
+    if args.batch != None:
+        recoverDecks()
+        migrateDecks()
+        if args.batch == '-':
+            sys.exit(runBatch(sys.stdin))
+        with open(args.batch, encoding='utf8') as f:
+            sys.exit(runBatch(f))
+    # Finish any deck writes cut short, then convert any decks still stored one card object per copy
+    recoverDecks()
+    migrateDecks()
     print('Welcome to the MTG Fold!\nEnter "help" for help.')
     while True:
+        finishCommand()
         print('> ', end=''),
         command = input().lower()
+        startCommand(command)
         if command == 'help' or command == 'h':
-            print('Options:\n- New Deck\n- Clone Deck\n- Delete Deck\n- List Decks\n- View Deck\n- Export Deck\n- View Card\n- Add Card\n- Add From File\n- Remove Card\n- Replace Card\n- Goldfish\n- Pull Data\n- Quit')
+            print('Options:\n- New Deck\n- Clone Deck\n- Delete Deck\n- List Decks\n- View Deck\n- Deck Stats\n- Pool Stats\n- Card Usage\n- Deck Diff\n- Similar Decks\n- Export Deck\n- View Card\n- Search\n- Image Cache\n- Prefetch Images\n- Contact Sheet\n- Add Card\n- Add From File\n- Remove Card\n- Replace Card\n- Goldfish\n- Simulate\n- Pull Data\n- Build Store\n- Stats\n- Quit')
         elif command == 'new deck' or command == 'new':
             defaultDeckName = getDefaultDeckName()
             print('Enter deck name: (' + defaultDeckName + ')')
@@ -536,11 +3476,17 @@ if __name__ == '__main__':
                 updateRecentDeck(deckName)
             defaultDeckName = 'new' + deckName
             print('Enter new deck name: (' + defaultDeckName + ')')
-            deckName = input()
-            if deckName == '':
-                deckName = defaultDeckName
-            createDeck(deckName)
-            updateRecentDeck(deckName)
+            newName = input()
+            if newName == '':
+                newName = defaultDeckName
+            res = cloneDeck(deckName, newName)
+            if res == -1:
+                print('Deck does not exist')
+            elif res == -2:
+                print('Deck already exists')
+            else:
+                print(newName + ' was cloned from ' + deckName)
+                updateRecentDeck(newName)
         elif command == 'delete deck' or command == 'delete':
             recentDeckName = getRecentDeckName()
             print('Delete deck: (' + recentDeckName + ')')
@@ -564,8 +3510,17 @@ if __name__ == '__main__':
                 updateRecentDeck(deckName)
             print('Export to file:')
             fileName = input()
-            exportDeck(deckName, fileName)
-            print('Exported ' + deckName)
+            print('Format: (default, plain, mtgo, arena or csv)')
+            fmt = input().lower()
+            if fmt == '':
+                fmt = 'default'
+            res = exportDeck(deckName, fileName, fmt)
+            if res == -1:
+                print('Deck or file does not exist')
+            elif res == -2:
+                print('Format not recognized')
+            else:
+                print('Exported ' + deckName)
         elif command == 'view deck':
             recentDeckName = getRecentDeckName()
             print('View deck: (' + recentDeckName + ')')
@@ -575,13 +3530,133 @@ if __name__ == '__main__':
             else:
                 updateRecentDeck(deckName)
             printDeck(deckName)
+        elif command == 'deck stats':
+            recentDeckName = getRecentDeckName()
+            print('Deck stats for: (' + recentDeckName + ')')
+            deckName = input()
+            if deckName == '':
+                deckName = recentDeckName
+            else:
+                updateRecentDeck(deckName)
+            stats = deckStats(deckName)
+            if stats == None:
+                print('Deck does not exist')
+            else:
+                printCardStats(stats)
+        elif command == 'card usage' or command == 'usage':
+            print('Enter card name:')
+            cardName = inputCardName()
+            usage = cardUsage(cardName)
+            if len(usage) == 0:
+                print('No decks use ' + cardName)
+            for deckName, quantity in usage:
+                print(str(quantity) + ' in ' + deckName)
+        elif command == 'deck diff' or command == 'diff':
+            recentDeckName = getRecentDeckName()
+            print('Compare deck: (' + recentDeckName + ')')
+            deckName = input()
+            if deckName == '':
+                deckName = recentDeckName
+            else:
+                updateRecentDeck(deckName)
+            print('With deck:')
+            otherName = input()
+            differences = diffDecks(deckName, otherName)
+            if differences == None:
+                print('Deck does not exist')
+            elif len(differences) == 0:
+                print('Decks are the same')
+            else:
+                for cardName, quantity, otherQuantity in differences:
+                    change = otherQuantity - quantity
+                    print(('+' if change > 0 else '') + str(change) + ' ' + cardName + ' (' + str(quantity) + ' -> ' + str(otherQuantity) + ')')
+        elif command == 'similar decks' or command == 'similar':
+            recentDeckName = getRecentDeckName()
+            print('Find decks similar to: (' + recentDeckName + ')')
+            deckName = input()
+            if deckName == '':
+                deckName = recentDeckName
+            else:
+                updateRecentDeck(deckName)
+            scores = similarDecks(deckName)
+            if scores == None:
+                print('Deck does not exist')
+            elif len(scores) == 0:
+                print('No decks share cards with ' + deckName)
+            for otherName, similarity in scores or []:
+                print(otherName + ': ' + str(round(100 * similarity, 1)) + '%')
+        elif command == 'pool stats':
+            printCardStats(poolStats())
         elif command == 'view card':
             print('Enter card name:')
-            cardName=input()
-            printCard(cardName)
+            cardName=inputCardName()
+            res = printCard(cardName)
+            if res == -1:
+                print("Card not found.")
+                printSuggestions(cardName)
+        elif command == 'search':
+            print('Enter search:')
+            results = searchCards(input())
+            if results == None:
+                print('Search not recognized')
+            else:
+                for cardName in results:
+                    print(cardName)
+                print(str(len(results)) + ' cards found')
+            if results != None and len(results) > 0:
+                # Offer to add every result in one batch, optionally followed by a quantity for each
+                print('Add results to: (skip)')
+                deckName, cardQuantity = parseCardRequest(input())
+                if deckName != '':
+                    updateRecentDeck(deckName)
+                    res, misses = addManyToDeck([(cardName, cardQuantity) for cardName in results], deckName)
+                    if res == -1:
+                        print('Deck does not exist')
+                    elif res == -2:
+                        print('Nothing was added to ' + deckName)
+                    elif cardQuantity < 1:
+                        print('Quantity must be at least 1')
+                    else:
+                        print('Added ' + str((len(results) - len(misses)) * cardQuantity) + ' cards to ' + deckName)
+        elif command == 'image cache':
+            printImageCacheStats()
+        elif command == 'prefetch images' or command == 'prefetch':
+            recentDeckName = getRecentDeckName()
+            print('Prefetch images for: (' + recentDeckName + ')')
+            deckName = input()
+            if deckName == '':
+                deckName = recentDeckName
+            else:
+                updateRecentDeck(deckName)
+            res, fetched, failures = prefetchDeckImages(deckName)
+            if res == -1:
+                print('Deck does not exist')
+            else:
+                for cardName in failures:
+                    print('Image for ' + cardName + ' could not be fetched.')
+                print(str(fetched) + ' images fetched')
+        elif command == 'contact sheet' or command == 'sheet':
+            recentDeckName = getRecentDeckName()
+            print('Render deck: (' + recentDeckName + ')')
+            deckName = input()
+            if deckName == '':
+                deckName = recentDeckName
+            else:
+                updateRecentDeck(deckName)
+            print('Enter file name, ending in .png or .pdf: (' + deckName + '.png)')
+            fileName = input()
+            if fileName == '':
+                fileName = deckName + '.png'
+            res, missing = renderContactSheet(deckName, fileName)
+            if res == -1:
+                print('Deck does not exist')
+            else:
+                if len(missing) > 0:
+                    print(str(len(missing)) + ' cards have no cached image. Enter "prefetch" to download them')
+                print('Rendered ' + deckName + ' to ' + fileName)
         elif command == 'add card' or command == 'add':
             print('Enter card name:')
-            cardName, cardQuantity = parseCardRequest(input())
+            cardName, cardQuantity = parseCardRequest(inputCardName())
             recentDeckName = getRecentDeckName()
             print('Add to: (' + recentDeckName + ')')
             deckName = input()
@@ -590,29 +3665,32 @@ if __name__ == '__main__':
             else:
                 updateRecentDeck(deckName)
             if cardName == 'random':
-                randCards = []
-                for _ in range(cardQuantity):
-                    card = lookupRandom()
-                    cardName = card['name']
-                    addToDeck(cardName, deckName)
-                    randCards.append(cardName)
-                print('Added the following cards:')
-                for i in range(cardQuantity):
-                    print(randCards[i])
-            else:
-                found = True
-                for _ in range(cardQuantity):
-                    res = addToDeck(cardName, deckName)
-                    if res == -1:
-                        found = False
-                        break
-                if found:
+                print('Filters: (none)')
+                filters = parseSampleFilters(input())
+                if filters == None:
+                    print('Filters not recognized')
+                else:
+                    # Draw every random card at once
+                    randCards = [card['name'] for card in sampleCards(cardQuantity, **filters)]
+                    addManyToDeck([(cardName, 1) for cardName in randCards], deckName)
+                    print('Added the following cards:')
+                    for i in range(len(randCards)):
+                        print(randCards[i])
+            else:
+                res, misses = addManyToDeck([(cardName, cardQuantity)], deckName)
+                if res == -1:
+                    print('Deck does not exist')
+                elif cardQuantity < 1:
+                    print('Quantity must be at least 1')
+                elif res == 0 and len(misses) == 0:
                     print("Added ", end="")
                     if cardQuantity > 1:
                         print(str(cardQuantity) + "x ", end="")
                     print(cardName)
                 else:
                     print("Card not found.")
+                    for cardName in misses:
+                        printSuggestions(cardName)
         elif command == 'add from file' or command == 'adds':
             print('Enter file name:')
             fileName = input()
@@ -627,23 +3705,30 @@ if __name__ == '__main__':
                 with open(fileName, 'r') as f:
                     addStr = f.read()
                     addList = addStr.split('\n')
-                    addCount = 0
-                    failCount = 0
-                    for addCard in addList:
-                        cardName, cardQuantity = parseCardRequest(addCard)
-                        addCount += cardQuantity
-                        for _ in range(cardQuantity):
-                            res = addToDeck(cardName, deckName)
-                            if res == -1:
+                    # Parse every non-blank line, then add them all in one batch
+                    cardRequests = [parseCardRequest(addCard) for addCard in addList if addCard.strip() != '']
+                    res, misses = addManyToDeck(cardRequests, deckName)
+                    if res == -1:
+                        print('Deck does not exist')
+                    elif res == -2:
+                        print('Nothing was added to ' + deckName)
+                    else:
+                        # Lines with quantities below 1 are skipped rather than looked up
+                        invalidKeys = set([normalizeName(cardName) for cardName, cardQuantity in cardRequests if cardQuantity < 1])
+                        for cardName in misses:
+                            if normalizeName(cardName) in invalidKeys:
+                                print('Quantity of ' + cardName + ' must be at least 1.')
+                            else:
                                 print('Card ' + cardName + ' was not found.')
-                                failCount += 1
-                                break
-                    print(str(addCount-failCount) + ' cards added')
+                                printSuggestions(cardName)
+                        missedKeys = set([normalizeName(cardName) for cardName in misses]) - invalidKeys
+                        addCount = sum([cardQuantity for cardName, cardQuantity in cardRequests if cardQuantity >= 1 and normalizeName(cardName) not in missedKeys])
+                        print(str(addCount) + ' cards added')
             except FileNotFoundError:
                 print('Specified file does not exist')
         elif command == 'remove card' or command == 'remove':
             print('Enter card name: ')
-            cardName, cardQuantity = parseCardRequest(input())
+            cardName, cardQuantity = parseCardRequest(inputCardName())
             recentDeckName = getRecentDeckName()
             print('Remove from: (' + recentDeckName + ')')
             deckName = input()
@@ -651,13 +3736,8 @@ if __name__ == '__main__':
                 deckName = recentDeckName
             else:
                 updateRecentDeck(deckName)
-            found = True
-            for _ in range(cardQuantity):
-                res = removeFromDeck(cardName, deckName)
-                if res == -1:
-                    found = False
-                    break
-            if found:
+            res, failures = commitDeckChanges(deckName, [('remove', cardName, cardQuantity)])
+            if res == 0:
                 print("Removed ", end="")
                 if cardQuantity > 1:
                     print(str(cardQuantity) + "x ", end="")
@@ -666,7 +3746,7 @@ if __name__ == '__main__':
                 print("Card not found in deck.")
         elif command == 'replace card' or command == 'replace':
             print('Enter name of card to remove: ')
-            cardName, cardQuantity = parseCardRequest(input())
+            removeName, removeQuantity = parseCardRequest(inputCardName())
             recentDeckName = getRecentDeckName()
             print('Remove from: (' + recentDeckName + ')')
             deckName = input()
@@ -674,45 +3754,42 @@ if __name__ == '__main__':
                 deckName = recentDeckName
             else:
                 updateRecentDeck(deckName)
-            found = True
-            for _ in range(cardQuantity):
-                res = removeFromDeck(cardName, deckName)
-                if res == -1:
-                    found = False
-                    break
-            if found:
+            print('Enter name of card to add: ')
+            addName, addQuantity = parseCardRequest(inputCardName())
+            # Stage the removal and the addition together so the deck is never left half-replaced
+            changes = [('remove', removeName, removeQuantity)]
+            randCards = []
+            if addName.lower() == 'random':
+                # Draw every random card at once
+                randCards = [card['name'] for card in sampleCards(addQuantity)]
+                changes += [('add', cardName, 1) for cardName in randCards]
+            else:
+                changes.append(('add', addName, addQuantity))
+            res, failures = commitDeckChanges(deckName, changes)
+            if res == -1:
+                print('Deck does not exist')
+            elif res == -2:
+                for cardName in failures:
+                    if cardName == removeName:
+                        print("Card " + cardName + " not found in deck.")
+                    else:
+                        print("Card " + cardName + " not found.")
+                        printSuggestions(cardName)
+                print('Deck was not changed')
+            else:
                 print("Removed ", end="")
-                if cardQuantity > 1:
-                    print(str(cardQuantity) + "x ", end="")
-                print(cardName)
-                print('Enter name of card to add: ')
-                cardName, cardQuantity = parseCardRequest(input())
-                if cardName.lower() == 'random':
-                    randCards = []
-                    for _ in range(cardQuantity):
-                        card = lookupRandom()
-                        cardName = card['name']
-                        addToDeck(cardName, deckName)
-                        randCards.append(cardName)
+                if removeQuantity > 1:
+                    print(str(removeQuantity) + "x ", end="")
+                print(removeName)
+                if addName.lower() == 'random':
                     print('Added the following cards:')
-                    for i in range(cardQuantity):
+                    for i in range(len(randCards)):
                         print(randCards[i])
                 else:
-                    found = True
-                    for _ in range(cardQuantity):
-                        res = addToDeck(cardName, deckName)
-                        if res == -1:
-                            found = False
-                            break
-                    if found:
-                        print("Added ", end="")
-                        if cardQuantity > 1:
-                            print(str(cardQuantity) + "x ", end="")
-                        print(cardName)
-                    else:
-                        print("Card not found.") 
-            else:
-                print("Card not found in deck.")       
+                    print("Added ", end="")
+                    if addQuantity > 1:
+                        print(str(addQuantity) + "x ", end="")
+                    print(addName)
         elif command == 'goldfish':
             recentDeckName = getRecentDeckName()
             print('Goldfish with: (' + recentDeckName + ')')
@@ -722,11 +3799,51 @@ if __name__ == '__main__':
             else:
                 updateRecentDeck(deckName)
             goldfish(deckName)
+        elif command == 'simulate':
+            recentDeckName = getRecentDeckName()
+            print('Simulate with: (' + recentDeckName + ')')
+            deckName = input()
+            if deckName == '':
+                deckName = recentDeckName
+            else:
+                updateRecentDeck(deckName)
+            print('Number of turns: (4)')
+            turns = input()
+            print('Cards to track, separated by semicolons: (none)')
+            targets = [target.strip() for target in input().split(';') if target.strip() != '']
+            try:
+                stats = simulateGoldfish(deckName, turns=int(turns) if turns != '' else 4, targets=targets, workers=os.cpu_count() or 1)
+                if stats == None:
+                    print('Deck does not exist or is empty')
+                else:
+                    printGoldfishStats(stats)
+            except ValueError:
+                print('Number of turns must be a whole number')
         elif command == 'pull data' or command == 'pull':
             pullData()
+        elif command == 'build store':
+            buildCardStore()
+            print('Card store built')
+        elif command == 'stats':
+            if metrics == None:
+                print('Instrumentation is off. Start with --instrument to collect stats')
+            else:
+                printStats()
+                print('Export format (json, prometheus): (skip)')
+                fmt = input().lower()
+                if fmt != '':
+                    print('Enter file name:')
+                    fileName = input()
+                    if exportStats(fileName, fmt) == -1:
+                        print('Format not recognized')
+                    else:
+                        print('Stats exported to ' + fileName)
         elif command == 'quit' or command == 'q':
+            finishCommand()
             break
         else:
+            # Time unrecognized commands under one name rather than whatever was typed
+            renameCommand('unrecognized')
             print('Command not recognized. Enter "help" for help.')
 
 
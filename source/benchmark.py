@@ -0,0 +1,289 @@
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import random as rng
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# The deck builder reads and writes everything relative to the working directory, so it is imported from beside this file and run inside a scratch directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import CLdeckbuilder
+
+# Card types to draw synthetic cards from, weighted roughly as in a real Oracle
+SYNTHETIC_TYPES = ['Creature — Elf Warrior', 'Creature — Human Wizard', 'Legendary Creature — Dragon', 'Instant', 'Sorcery', 'Enchantment', 'Enchantment — Aura', 'Artifact', 'Artifact Creature — Golem', 'Planeswalker — Jace', 'Land', 'Basic Land — Forest']
+# Words to build card names and rules text from
+SYNTHETIC_WORDS = ['Ancient', 'Blazing', 'Crypt', 'Drake', 'Ember', 'Fury', 'Grove', 'Hollow', 'Iron', 'Jade', 'Kraken', 'Lotus', 'Mire', 'Night', 'Oath', 'Pyre', 'Quill', 'Rune', 'Storm', 'Thorn', 'Umbra', 'Vigil', 'Wraith', 'Zephyr']
+SYNTHETIC_TEXT = ['Flying', 'Trample', 'Draw a card.', 'Deal 3 damage to any target.', 'Destroy target creature.', 'Counter target spell.', 'Add one mana of any color.', 'Target player gains 4 life.', 'Return target creature to its owner\'s hand.', 'Create a 1/1 green Elf creature token.']
+# Formats listed in the legalities of each synthetic card
+SYNTHETIC_FORMATS = ['standard', 'pioneer', 'modern', 'legacy', 'vintage', 'commander', 'pauper']
+
+"""
+param: index, position of the card in the synthetic Oracle, which keeps its name unique.
+param: random, random number generator to draw the card's attributes from.
+return: JSON card object shaped like a card in the Scryfall Oracle.
+"""
+def generateCard(index:int, random:rng.Random) -> dict:
+    typeLine = random.choice(SYNTHETIC_TYPES)
+    name = random.choice(SYNTHETIC_WORDS) + ' ' + random.choice(SYNTHETIC_WORDS) + ' ' + str(index)
+    # Give a share of the names punctuation and accents, as real names have
+    if index % 11 == 0:
+        name = name + ', the Ünbound'
+    card = {'object' : 'card', 'id' : 'synthetic-' + str(index), 'oracle_id' : 'synthetic-oracle-' + str(index), 'name' : name, 'lang' : 'en', 'layout' : 'normal', 'type_line' : typeLine}
+    if 'Land' in typeLine:
+        card['mana_cost'] = ''
+        card['cmc'] = 0.0
+        card['colors'] = []
+        card['oracle_text'] = '{T}: Add {G}.'
+    else:
+        colors = random.sample('WUBRG', random.choice([0, 1, 1, 1, 2, 2, 3]))
+        generic = random.randint(0, 5)
+        card['mana_cost'] = ('{' + str(generic) + '}' if generic > 0 else '') + ''.join(['{' + color + '}' for color in colors])
+        card['cmc'] = float(generic + len(colors))
+        card['colors'] = colors
+        card['oracle_text'] = '\n'.join(random.sample(SYNTHETIC_TEXT, random.randint(1, 3)))
+    card['color_identity'] = card['colors']
+    if 'Creature' in typeLine:
+        card['power'] = str(random.randint(0, 8))
+        card['toughness'] = str(random.randint(1, 8))
+    card['legalities'] = dict([(fmt, random.choice(['legal', 'legal', 'not_legal', 'banned'])) for fmt in SYNTHETIC_FORMATS])
+    card['set'] = 'syn'
+    card['collector_number'] = str(index)
+    card['rarity'] = random.choice(['common', 'uncommon', 'rare', 'mythic'])
+    card['image_uris'] = {'png' : 'https://cards.scryfall.io/png/front/synthetic/' + str(index) + '.png'}
+    return card
+# END GENERATECARD
+
+"""
+param: fileName, name of file to write the synthetic Oracle to.
+param: size, number of cards in the synthetic Oracle.
+param: seed, seed of the random number generator, so the same arguments always produce the same Oracle.
+post: file param:fileName holds a JSON array of param:size synthetic cards, laid out one card per line as in the Scryfall bulk data.
+return: the name of every card written, in order.
+"""
+def generateOracle(fileName:str, size:int, seed:int=0) -> list:
+    random = rng.Random(seed)
+    names = []
+    with open(fileName, 'w', encoding='utf8') as f:
+        f.write('[\n')
+        for index in range(size):
+            card = generateCard(index, random)
+            names.append(card['name'])
+            f.write(json.dumps(card, ensure_ascii=False))
+            f.write(',\n' if index < size-1 else '\n')
+        f.write(']\n')
+    return names
+# END GENERATEORACLE
+
+"""
+param: names, names of the cards to build the deck from.
+param: random, random number generator to draw the deck with.
+param: deckSize, number of cards in the deck.
+return: dictionary mapping the name of each card in the deck to its quantity, as stored by the deck builder.
+"""
+def generateDeck(names:list, random:rng.Random, deckSize:int=60) -> dict:
+    deck = {}
+    # Most cards run as playsets, with a few singletons filling out the list
+    while sum(deck.values()) < deckSize:
+        quantity = min(random.choice([1, 2, 4, 4]), deckSize - sum(deck.values()))
+        name = random.choice(names)
+        deck[name] = deck.get(name, 0) + quantity
+    return deck
+# END GENERATEDECK
+
+"""
+param: size, number of cards in the synthetic Oracle.
+param: decks, number of synthetic decks to write.
+param: seed, seed of the random number generator.
+post: the working directory is laid out as the deck builder expects, with a synthetic Oracle, its name index and card store, an empty cache and param:decks synthetic decks named 'deck0', 'deck1' and so on.
+return: the name of every card in the synthetic Oracle.
+"""
+def generateWorkspace(size:int, decks:int=10, seed:int=0) -> list:
+    for folder in ['data', 'data/decks', 'data/images']:
+        os.makedirs(folder, exist_ok=True)
+    names = generateOracle('data/oracle.json', size, seed)
+    open('data/cache.jsonl', 'w', encoding='utf8').close()
+    with open('data/decks/_details.txt', 'w', encoding='utf8') as f:
+        f.write('0deck0')
+    random = rng.Random(seed)
+    for i in range(decks):
+        CLdeckbuilder.saveDeck('deck' + str(i), generateDeck(names, random))
+    # Build what a pull would build, so lookups take the same path as after a real pull
+    CLdeckbuilder.buildIndex()
+    CLdeckbuilder.buildCardStore()
+    return names
+# END GENERATEWORKSPACE
+
+"""
+param: names, the name of every card in the synthetic Oracle.
+return: dictionary mapping the name of each benchmark to a function running it once. Each function takes the number of the run, so runs that must not repeat work (such as looking up a card that is not yet cached) can pick a fresh input.
+"""
+def getBenchmarks(names:list) -> dict:
+    app = CLdeckbuilder
+    random = rng.Random(1)
+    # Cards looked up for the first time are taken from the back of the Oracle, well away from the cards in the synthetic decks
+    fresh = names[::-1]
+    app.lookupCard(names[0])
+    # A decklist as read by the 'add from file' command, with a couple of names that will not be found
+    decklist = [name + ' 4' for name in random.sample(names, 15)] + ['Nonexistent Card ' + str(i) + ' 1' for i in range(2)]
+    app.createDeck('scratch')
+    """
+    param: function, function whose output is not of interest.
+    return: function which runs param:function with its printed output discarded.
+    """
+    def quiet(function):
+        def run(*args):
+            with contextlib.redirect_stdout(io.StringIO()):
+                return function(*args)
+        return run
+    """
+    param: i, number of the run.
+    post: a fresh deck is created, and the synthetic decklist is parsed and added to it in one batch.
+    """
+    def bulkImport(i:int):
+        app.createDeck('bulk' + str(i))
+        cardRequests = [app.parseCardRequest(line) for line in decklist]
+        app.addManyToDeck(cardRequests, 'bulk' + str(i))
+    return {
+        'lookupCard (cached)' : lambda i: app.lookupCard(names[0]),
+        'lookupCard (uncached)' : lambda i: app.lookupCard(fresh[i % len(fresh)]),
+        'lookupCard (miss)' : lambda i: app.lookupCard('Nonexistent Card ' + str(i)),
+        'cacheData' : lambda i: app.cacheData({'name' : 'Cached Card ' + str(i), 'type_line' : 'Instant'}),
+        'addToDeck' : lambda i: app.addToDeck(names[i % 100], 'scratch'),
+        'removeFromDeck' : lambda i: app.removeFromDeck(names[i % 100], 'scratch'),
+        'printDeck' : quiet(lambda i: app.printDeck('deck' + str(i % 10))),
+        'exportDeck' : lambda i: app.exportDeck('deck' + str(i % 10), 'export.txt'),
+        'goldfish' : quiet(lambda i: app.goldfish('deck' + str(i % 10))),
+        'bulk import' : bulkImport,
+    }
+# END GETBENCHMARKS
+
+"""
+param: function, benchmark function as returned by method:getBenchmarks().
+param: runs, number of timed runs.
+param: offset, number of runs already made of param:function, so each run gets a fresh number.
+return: dictionary holding the median and minimum time of a run in seconds, and the peak memory allocated by a single run in bytes.
+"""
+def measure(function, runs:int, offset:int=0) -> dict:
+    times = []
+    for i in range(offset, offset+runs):
+        start = time.perf_counter()
+        function(i)
+        times.append(time.perf_counter() - start)
+    # Trace memory over one extra run only, as tracing slows every allocation down
+    tracemalloc.start()
+    function(offset+runs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'median' : statistics.median(times), 'min' : min(times), 'peak' : peak}
+# END MEASURE
+
+"""
+param: size, number of cards in the synthetic Oracle.
+param: runs, number of timed runs of each benchmark.
+param: seed, seed of the random number generator.
+post: every benchmark is run against a synthetic workspace in a temporary directory, which is removed afterwards.
+return: dictionary mapping the name of each benchmark to its measurements (see method:measure()).
+"""
+def runBenchmarks(size:int, runs:int, seed:int=0) -> dict:
+    global CLdeckbuilder
+    cwd = os.getcwd()
+    workspace = tempfile.mkdtemp(prefix='deckbuilder-bench-')
+    try:
+        os.chdir(workspace)
+        # Reload the deck builder so nothing it holds in memory carries over from the last workspace
+        CLdeckbuilder = importlib.reload(CLdeckbuilder)
+        names = generateWorkspace(size, seed=seed)
+        results = {}
+        for benchmarkName, function in getBenchmarks(names).items():
+            # One untimed run warms up any index the benchmark loads on first use
+            function(0)
+            results[benchmarkName] = measure(function, runs, 1)
+        if CLdeckbuilder.cardStore != None:
+            CLdeckbuilder.cardStore.close()
+        CLdeckbuilder.closeOracleMap()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+    return results
+# END RUNBENCHMARKS
+
+"""
+param: results, measurements of the current run, keyed by Oracle size and benchmark name.
+param: baseline, measurements of an earlier run in the same form.
+param: threshold, fraction by which a measurement may exceed its baseline before it counts as a regression.
+return: description of every regression, if any. Time differences under 0.2 ms or the baseline's own spread, and memory differences under 64 KiB, are taken as noise.
+"""
+def findRegressions(results:dict, baseline:dict, threshold:float) -> list:
+    regressions = []
+    for size, benchmarks in results.items():
+        for benchmarkName, result in benchmarks.items():
+            base = baseline.get(size, {}).get(benchmarkName)
+            if base == None:
+                continue
+            # Compare the fastest runs, which vary far less than the medians, and allow for the spread the baseline itself showed, which is wide for benchmarks that write to disk
+            noise = max(0.0002, base['median'] - base['min'])
+            if result['min'] > base['min'] * (1+threshold) and result['min'] - base['min'] > noise:
+                regressions.append('%s (%s cards): fastest run %.3f ms, baseline %.3f ms' % (benchmarkName, size, result['min']*1000, base['min']*1000))
+            if result['peak'] > base['peak'] * (1+threshold) and result['peak'] - base['peak'] > 65536:
+                regressions.append('%s (%s cards): peak memory %d KiB, baseline %d KiB' % (benchmarkName, size, result['peak']//1024, base['peak']//1024))
+    return regressions
+# END FINDREGRESSIONS
+
+"""
+param: size, number of cards in the synthetic Oracle.
+param: benchmarks, measurements keyed by benchmark name.
+post: a table of the measurements is displayed.
+"""
+def printResults(size:str, benchmarks:dict):
+    print(size + ' cards')
+    for benchmarkName, result in benchmarks.items():
+        print('  %-24s median %9.3f ms   min %9.3f ms   peak %8d KiB' % (benchmarkName, result['median']*1000, result['min']*1000, result['peak']//1024))
+# END PRINTRESULTS
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the deck builder against synthetic Oracles, which fail when performance regresses from a saved baseline.')
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated Oracle sizes to benchmark, from 1000 to 100000 cards (default: 1000,10000)')
+    parser.add_argument('--runs', type=int, default=50, help='timed runs of each benchmark (default: 50)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data (default: 0)')
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json'), help='JSON file of baseline measurements, which must exist unless --save is given (default: benchmark_baseline.json beside this script)')
+    parser.add_argument('--save', action='store_true', help='save the measurements as the new baseline instead of comparing against it')
+    parser.add_argument('--threshold', type=float, default=0.25, help='fraction a measurement may exceed its baseline by before failing (default: 0.25)')
+    parser.add_argument('--generate', metavar='FOLDER', help='only write a synthetic workspace (Oracle, index, card store and decks) to FOLDER, of the first size given')
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    if args.generate != None:
+        os.makedirs(args.generate, exist_ok=True)
+        os.chdir(args.generate)
+        generateWorkspace(sizes[0], seed=args.seed)
+        sys.exit(0)
+    # Without a baseline there is nothing to gate on, so fail before spending time on runs rather than passing silently
+    baseline = None
+    if not args.save:
+        try:
+            with open(args.baseline, encoding='utf8') as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print('No baseline at ' + args.baseline + ' to compare against, run with --save to record one')
+            sys.exit(2)
+    results = {}
+    for size in sizes:
+        results[str(size)] = runBenchmarks(size, args.runs, args.seed)
+        printResults(str(size), results[str(size)])
+    if args.save:
+        with open(args.baseline, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=1)
+        print('Baseline saved to ' + args.baseline)
+        sys.exit(0)
+    regressions = findRegressions(results, baseline, args.threshold)
+    for regression in regressions:
+        print('Regression: ' + regression)
+    if len(regressions) > 0:
+        sys.exit(1)
+    print('No regressions')